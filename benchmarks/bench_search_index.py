@@ -0,0 +1,76 @@
+"""
+Compares building the `search_index` column row by row (the previous
+`agg("||".join, axis=1)` implementation) with the column-wise join used by
+`add_search_index_to_search_terms`, and with an incremental rebuild where only
+newly appended rows are recomputed.
+
+Usage:
+    python benchmarks/bench_search_index.py [rows ...]
+
+Rows default to 100000 1000000 10000000. The 10M row table needs several GB
+of memory.
+"""
+
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from ckanext.searchterms.jobs import add_search_index_to_search_terms, get_indexcols
+
+DEFAULT_ROWS = [100000, 1000000, 10000000]
+# Share of rows that are new when measuring the incremental rebuild
+NEW_ROWS_FRACTION = 0.01
+
+
+def make_searchterms(rows, term_cols=3, rsrc_cols=2):
+    rng = np.random.default_rng(0)
+    data = {"id": np.char.add("id-", np.arange(rows).astype(str)).astype(object)}
+    for i in range(term_cols):
+        values = rng.integers(0, rows, size=rows).astype(str)
+        data["Term {0}".format(i)] = np.char.add("term-", values).astype(object)
+    for i in range(rsrc_cols):
+        data["rsrc-{0}".format(i)] = np.where(rng.random(rows) < 0.5, "True", "")
+    return pd.DataFrame(data)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def rowwise(searchterms_df):
+    indexable_cols = get_indexcols(searchterms_df)
+    searchterms_df["search_index"] = searchterms_df[indexable_cols].agg(
+        "||".join, axis=1
+    )
+
+
+def main(row_counts):
+    print(
+        "{0:>10} {1:>10} {2:>10} {3:>12} {4:>8}".format(
+            "rows", "row-wise", "columnar", "incremental", "speedup"
+        )
+    )
+    for rows in row_counts:
+        searchterms_df = make_searchterms(rows)
+        before = timed(rowwise, searchterms_df.copy())
+        after = timed(add_search_index_to_search_terms, searchterms_df.copy())
+
+        indexed = add_search_index_to_search_terms(searchterms_df.copy())
+        new_rows = np.random.default_rng(1).random(rows) < NEW_ROWS_FRACTION
+        indexed.loc[new_rows, "search_index"] = ""
+        incremental = timed(
+            add_search_index_to_search_terms, indexed, reuse_existing=True
+        )
+        print(
+            "{0:>10} {1:>9.2f}s {2:>9.2f}s {3:>11.2f}s {4:>7.1f}x".format(
+                rows, before, after, incremental, before / after
+            )
+        )
+
+
+if __name__ == "__main__":
+    main([int(rows) for rows in sys.argv[1:]] or DEFAULT_ROWS)
@@ -0,0 +1,105 @@
+"""
+Fixtures for the searchterms pipeline benchmarks.
+
+Run with pytest-benchmark, e.g.
+
+    python -m pytest benchmarks --benchmark-only --bench-rows 10000,1000000
+
+Table sizes default to 10000 and 100000 rows; pass up to 10000000 to
+`--bench-rows` for the largest catalogs (several GB of memory). Resource
+column counts default to 2 and 10 (`--bench-rsrc-cols`).
+"""
+
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ckanext.searchterms.jobs import create_initial_searchterms
+from ckanext.searchterms.tests.conftest import storage  # noqa: F401
+
+DEFAULT_ROWS = "10000,100000"
+DEFAULT_RSRC_COLS = "2,10"
+TERM_COLS = 3
+ROUNDS = 3
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--bench-rows",
+        default=DEFAULT_ROWS,
+        help="Comma-separated search terms table sizes to benchmark",
+    )
+    parser.addoption(
+        "--bench-rsrc-cols",
+        default=DEFAULT_RSRC_COLS,
+        help="Comma-separated numbers of resource columns to benchmark",
+    )
+
+
+def pytest_generate_tests(metafunc):
+    for fixture, option in [
+        ("rows", "--bench-rows"),
+        ("rsrc_cols", "--bench-rsrc-cols"),
+    ]:
+        if fixture in metafunc.fixturenames:
+            values = [
+                int(value) for value in metafunc.config.getoption(option).split(",")
+            ]
+            metafunc.parametrize(fixture, values)
+
+
+def make_searchterms(rows, rsrc_cols, offset=0, seed=0):
+    """
+    Returns a synthetic search terms table: an identifier column, TERM_COLS
+    synonym columns and `rsrc_cols` resource columns. Every row is found in
+    rsrc-0 and in about half of the other resources.
+    """
+    rng = np.random.default_rng(seed)
+    ids = np.arange(offset, offset + rows).astype(str)
+    data = {"id": np.char.add("id-", ids).astype(object)}
+    for i in range(TERM_COLS):
+        values = rng.integers(0, rows, size=rows).astype(str)
+        data["Term {0}".format(i)] = np.char.add("term-", values).astype(object)
+    for i in range(rsrc_cols):
+        found = np.ones(rows, dtype=bool) if i == 0 else rng.random(rows) < 0.5
+        data["rsrc-{0}".format(i)] = np.where(found, "True", "").astype(object)
+    return pd.DataFrame(data)
+
+
+def make_new_terms(rows, rsrc_col):
+    """
+    Returns the terms of a new resource: half of them for existing identifiers
+    and a tenth for new ones.
+    """
+    new_terms = make_searchterms(rows // 2 + rows // 10, 0, offset=rows // 2, seed=1)
+    return create_initial_searchterms(rsrc_col, new_terms)
+
+
+def peak_memory_mb(func, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 2**20
+
+
+@pytest.fixture
+def run_benchmark(benchmark):
+    """
+    Times `func` on fresh arguments from `setup` each round, then records
+    its throughput in rows per second and the peak memory of one more run
+    in the benchmark's extra info.
+    """
+
+    def run(func, setup, rows):
+        benchmark.pedantic(func, setup=setup, rounds=ROUNDS, iterations=1)
+        args, kwargs = setup()
+        benchmark.extra_info["rows"] = rows
+        benchmark.extra_info["rows_per_second"] = rows / benchmark.stats.stats.mean
+        benchmark.extra_info["peak_memory_mb"] = peak_memory_mb(func, *args, **kwargs)
+
+    return run
@@ -0,0 +1,64 @@
+"""Benchmarks for the searchterms data pipeline."""
+
+import pytest
+
+from conftest import make_new_terms, make_searchterms
+
+from ckanext.searchterms.jobs import (
+    add_search_index_to_search_terms,
+    remove_resource_from_search_terms,
+    save_file,
+    update_searchterms,
+)
+from ckanext.searchterms.plugin import INDEX_CHUNK_ROWS, build_index_payload
+from ckanext.searchterms.storage import iter_search_terms_chunks
+
+pytest.importorskip("pytest_benchmark")
+
+
+def test_update_searchterms(run_benchmark, rows, rsrc_cols):
+    searchterms_df = make_searchterms(rows, rsrc_cols)
+    new_terms_df = make_new_terms(rows, "rsrc-new")
+
+    def setup():
+        return ("rsrc-new", new_terms_df.copy(), searchterms_df.copy()), {}
+
+    run_benchmark(update_searchterms, setup, rows)
+
+
+def test_remove_resource_from_search_terms(run_benchmark, rows, rsrc_cols):
+    searchterms_df = make_searchterms(rows, rsrc_cols)
+    rsrc_col = "rsrc-{0}".format(rsrc_cols - 1)
+
+    def setup():
+        return (rsrc_col, searchterms_df.copy()), {}
+
+    run_benchmark(remove_resource_from_search_terms, setup, rows)
+
+
+def test_add_search_index_to_search_terms(run_benchmark, rows, rsrc_cols):
+    searchterms_df = make_searchterms(rows, rsrc_cols)
+
+    def setup():
+        return (searchterms_df.copy(),), {}
+
+    run_benchmark(add_search_index_to_search_terms, setup, rows)
+
+
+def test_save_file(run_benchmark, storage, rows, rsrc_cols):
+    searchterms_df = add_search_index_to_search_terms(make_searchterms(rows, rsrc_cols))
+
+    def setup():
+        return (searchterms_df.copy(), "pkg"), {}
+
+    run_benchmark(save_file, setup, rows)
+
+
+def test_build_index_payload(run_benchmark, storage, rows, rsrc_cols):
+    searchterms_df = add_search_index_to_search_terms(make_searchterms(rows, rsrc_cols))
+    terms_id = save_file(searchterms_df, "pkg")["id"]
+
+    def setup():
+        return ("pkg", iter_search_terms_chunks(terms_id, INDEX_CHUNK_ROWS)), {}
+
+    run_benchmark(build_index_payload, setup, rows)
@@ -0,0 +1,92 @@
+from itertools import islice
+
+from ckan import model
+import ckan.plugins.toolkit as tk
+
+from .prefix_index import get_prefix_index
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+
+
+def get_limit(data_dict):
+    try:
+        limit = int(data_dict.get("limit", DEFAULT_LIMIT))
+    except (TypeError, ValueError):
+        raise tk.ValidationError({"limit": ["Must be an integer"]})
+    if limit < 1:
+        raise tk.ValidationError({"limit": ["Must be at least 1"]})
+    return min(limit, MAX_LIMIT)
+
+
+def get_required(data_dict, field):
+    value = data_dict.get(field)
+    if not isinstance(value, str) or not value.strip():
+        raise tk.ValidationError({field: ["Missing value"]})
+    return value
+
+
+def get_dataset_prefix_index(context, data_dict):
+    """
+    Returns the prefix index of the `package_id` dataset, or None if it has
+    none, after checking the user can read the dataset.
+    """
+    package = model.Package.get(get_required(data_dict, "package_id"))
+    if package is None:
+        raise tk.ObjectNotFound("Dataset not found")
+    tk.check_access("package_show", dict(context), {"id": package.id})
+    return get_prefix_index(package.id)
+
+
+@tk.side_effect_free
+def searchterms_autocomplete(context, data_dict):
+    """
+    Returns a dataset's search terms starting with a prefix, compared
+    case-insensitively.
+
+    :param package_id: the id or name of the dataset
+    :type package_id: string
+    :param q: the prefix to complete
+    :type q: string
+    :param limit: the maximum number of terms to return (default: 10, at
+        most 100)
+    :type limit: int
+
+    :returns: the matching terms in alphabetical order
+    :rtype: list of strings
+    """
+    tk.check_access("searchterms_autocomplete", context, data_dict)
+    prefix = get_required(data_dict, "q")
+    limit = get_limit(data_dict)
+    index = get_dataset_prefix_index(context, data_dict)
+    if index is None:
+        return []
+    return list(islice(index.iter_prefix(prefix), limit))
+
+
+@tk.side_effect_free
+def searchterms_lookup(context, data_dict):
+    """
+    Returns whether a dataset has a search term, compared case-insensitively.
+
+    :param package_id: the id or name of the dataset
+    :type package_id: string
+    :param term: the term to look up
+    :type term: string
+
+    :returns: the term as found in the dataset, or None if it is not
+    :rtype: string
+    """
+    tk.check_access("searchterms_lookup", context, data_dict)
+    term = get_required(data_dict, "term")
+    index = get_dataset_prefix_index(context, data_dict)
+    if index is None:
+        return None
+    return index.find(term)
+
+
+def get_actions():
+    return {
+        "searchterms_autocomplete": searchterms_autocomplete,
+        "searchterms_lookup": searchterms_lookup,
+    }
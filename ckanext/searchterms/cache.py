@@ -0,0 +1,138 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import ckan.plugins.toolkit as tk
+
+INDEX_CACHE_SIZE = "ckanext.searchterms.index_cache_size"
+DEFAULT_INDEX_CACHE_SIZE = 128
+INDEX_CACHE_MB = "ckanext.searchterms.index_cache_mb"
+DEFAULT_INDEX_CACHE_MB = 256
+
+log = logging.getLogger(__name__)
+
+_index_cache = None
+_pipeline_writes = threading.local()
+
+
+class LRUCache:
+    """
+    A small thread-safe least-recently-used cache.
+
+    Entries can be tagged with a package id so that every entry belonging to a
+    package can be dropped at once when its search terms file is rewritten.
+    A maxsize of 0 disables caching entirely. With `maxbytes`, entries are
+    also evicted while the sizes given to `set` add up to more than it, and
+    an entry larger than it is not cached at all.
+    """
+
+    def __init__(self, maxsize, maxbytes=0):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._packages = {}
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def set(self, key, value, package_id=None, size=0):
+        if self.maxsize <= 0 or (self.maxbytes and size > self.maxbytes):
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = value
+            self._packages[key] = package_id
+            self._sizes[key] = size
+            self.nbytes += size
+            while len(self._entries) > self.maxsize or (
+                self.maxbytes and self.nbytes > self.maxbytes
+            ):
+                self._pop(next(iter(self._entries)))
+
+    def _pop(self, key):
+        self._entries.pop(key, None)
+        self._packages.pop(key, None)
+        self.nbytes -= self._sizes.pop(key, 0)
+
+    def invalidate_package(self, package_id):
+        with self._lock:
+            stale = [key for key, pkg in self._packages.items() if pkg == package_id]
+            for key in stale:
+                self._pop(key)
+        if stale:
+            log.debug(
+                "Dropped {0} cached index entries for package {1}".format(
+                    len(stale), package_id
+                )
+            )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._packages.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+
+def get_index_cache():
+    """
+    Returns the process-wide cache of search terms index payloads, creating it
+    from the configured size on first use.
+    """
+    global _index_cache
+    if _index_cache is None:
+        maxsize = tk.asint(tk.config.get(INDEX_CACHE_SIZE, DEFAULT_INDEX_CACHE_SIZE))
+        maxbytes = tk.asint(tk.config.get(INDEX_CACHE_MB, DEFAULT_INDEX_CACHE_MB))
+        _index_cache = LRUCache(maxsize, maxbytes * 2**20)
+    return _index_cache
+
+
+def file_identity(filepath):
+    """
+    Returns a (size, mtime) tuple identifying the current contents of a file.
+    Other processes may rewrite the file, so this is part of every cache key.
+    """
+    stat = os.stat(filepath)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _get_pipeline_writes():
+    if not hasattr(_pipeline_writes, "packages"):
+        _pipeline_writes.packages = {}
+    return _pipeline_writes.packages
+
+
+@contextmanager
+def pipeline_write(package_id, terms_id=None, searchterms_df=None):
+    """
+    Marks a dataset write made by the searchterms jobs in this thread. While
+    it is active, indexing the package takes the terms of `terms_id` from
+    `searchterms_df`, which the job already holds, instead of reading the
+    file it has just written back from storage.
+    """
+    writes = _get_pipeline_writes()
+    writes[package_id] = (terms_id, searchterms_df)
+    try:
+        yield
+    finally:
+        writes.pop(package_id, None)
+
+
+def get_pipeline_write(package_id):
+    """
+    Returns the (terms_id, searchterms_df) of the package's current pipeline
+    write, or None if the package is not being written by a searchterms job.
+    """
+    return _get_pipeline_writes().get(package_id)
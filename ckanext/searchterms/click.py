@@ -19,6 +19,25 @@ def searchterms():
                             <dataset-id> - Submit a particular dataset's resources
 
                             all - Submit all datasets' resources to the DataStore
+
+                    With --fg, search terms are generated in this process, or
+                    for `all` in --workers processes, one dataset at a time each
+
+                    With --fg, `all` records finished datasets in a checkpoint
+                    file, and --resume skips the ones a previous run finished
+
+                    Resources whose file and plugin version have not changed
+                    keep their search terms, unless --force is given
+
+            searchterms reindex <dataset-spec>
+
+                    Rebuild the search index for the given datasets, resolving
+                    their search terms files in one query up front
+
+            searchterms stats [--days DAYS]
+
+                    Show percentiles of the time, rows and memory of each stage
+                    of the searchterms jobs recorded in task_status
     """
     pass
 
@@ -28,18 +47,103 @@ def searchterms():
 @click.option(
     "--fg", is_flag=True, default=False, help="Runs the gene tagger in the foreground"
 )
-def submit(dataset_spec, fg):
+@click.option(
+    "--workers",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of processes generating search terms for `all` with --fg",
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help="Skips the datasets a previous run of `all` with --fg finished",
+)
+@click.option(
+    "--checkpoint",
+    default=None,
+    help="File recording the datasets `all` with --fg has finished "
+    "(default: $CKAN_STORAGE_PATH/searchterms/submit_all.checkpoint)",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="Regenerates search terms even for resources that have not changed",
+)
+def submit(dataset_spec, fg, workers, resume, checkpoint, force):
     """
     searchterms submit <dataset-spec>
     """
-    cmd = SearchtermsCmd(fg)
+    cmd = SearchtermsCmd(fg, force)
     if dataset_spec == "all":
-        cmd.submit_all_pkgs()
+        cmd.submit_all_pkgs(workers, resume, checkpoint)
     else:
         dataset = cmd.identify_pkg(dataset_spec)
         if dataset:
             cmd.resubmit_pkg(dataset)
 
 
+@searchterms.command()
+@click.argument("dataset-spec")
+def reindex(dataset_spec):
+    """
+    searchterms reindex <dataset-spec>
+    """
+    cmd = SearchtermsCmd(False)
+    cmd.reindex(dataset_spec)
+
+
+@searchterms.command()
+@click.option(
+    "--days",
+    type=click.IntRange(min=1),
+    default=None,
+    help="Only include jobs that finished in the last DAYS days",
+)
+def stats(days):
+    """
+    searchterms stats [--days DAYS]
+    """
+    cmd = SearchtermsCmd(False)
+    summary = cmd.stats(days)
+    if not summary:
+        click.echo("No searchterms job timings recorded")
+        return
+    header = "{0:<16} {1:>6} {2:>10} {3:>9} {4:>9} {5:>9} {6:>9} {7:>11} {8:>12}"
+    row = "{0:<16} {1:>6} {2:>10.1f} {3:>9.2f} {4:>9.2f} {5:>9.2f} {6:>9.2f} {7:>11} {8:>12}"
+    click.echo(
+        header.format(
+            "stage",
+            "jobs",
+            "total (s)",
+            "p50 (s)",
+            "p90 (s)",
+            "p99 (s)",
+            "max (s)",
+            "p50 rows",
+            "max RSS (MB)",
+        )
+    )
+    for stage in summary:
+        click.echo(
+            row.format(
+                stage["stage"],
+                stage["count"],
+                stage["total"],
+                stage.get("seconds_p50", 0),
+                stage.get("seconds_p90", 0),
+                stage.get("seconds_p99", 0),
+                stage.get("seconds_max", 0),
+                "{0:.0f}".format(stage["rows_p50"]) if "rows_p50" in stage else "-",
+                (
+                    "{0:.0f}".format(stage["peak_rss_mb_max"])
+                    if "peak_rss_mb_max" in stage
+                    else "-"
+                ),
+            )
+        )
+
+
 def get_commands():
     return [searchterms]
@@ -1,21 +1,42 @@
+import os
 import logging
+import datetime
+import multiprocessing
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    as_completed,
+    wait,
+)
+
 import ckan.model as model
 import ckan.plugins.toolkit as toolkit
+from ckan.lib import search
 
+from .context import JobContext
 from .implementations import is_eligible
 from .jobs import (
-    check_search_terms_resource,
     enqueue_terms_job,
-    enqueue_xloader_searchterms,
+    revise_search_terms,
+    update_package_search_terms,
 )
-from .util import TERMS_RSRC_NAME, site_user_context
+from .instrumentation import summarize_stages
+from .locks import package_lock
+from .plugin import batch_terms_resources
+from .util import TERMS_RSRC_NAME, get_terms_resource_ids
+
+# Packages fetched per package_search request by `submit all`
+PAGE_SIZE = 1000
+CHECKPOINT_FILENAME = "submit_all.checkpoint"
 
 log = logging.getLogger(__name__)
 
 
 class SearchtermsCmd:
-    def __init__(self, fg):
+    def __init__(self, fg, force=False):
         self.run_in_foreground = fg
+        # Regenerate terms even for resources that have not changed
+        self.force = force
 
     def identify_pkg(self, cmd):
         # try with id
@@ -31,39 +52,95 @@ class SearchtermsCmd:
         else:
             return package
 
-    def submit_all_pkgs(self):
-        package_list = toolkit.get_action("package_search")(
-            {"model": model, "ignore_auth": True},
-            {"include_private": True, "rows": 1000},
+    def iter_all_pkgs(self):
+        """
+        Yields every package in the catalog, a page of package_search results
+        at a time. Sorting by id keeps the pages stable while jobs run.
+        """
+        start = 0
+        while True:
+            page = toolkit.get_action("package_search")(
+                {"model": model, "ignore_auth": True},
+                {
+                    "include_private": True,
+                    "rows": PAGE_SIZE,
+                    "start": start,
+                    "sort": "id asc",
+                },
+            )
+            results = page.get("results", [])
+            if start == 0:
+                log.info("Found {0} packages".format(page.get("count", "bzzt")))
+            for pkg in results:
+                yield pkg
+            start += len(results)
+            if not results or start >= page.get("count", 0):
+                return
+
+    def submit_pkg(self, pkg):
+        """
+        Submits a package from package_search. Returns its id, description and
+        number of searchterm jobs, or None for the jobs if submitting failed.
+        """
+        pkgid = pkg.get("id") + " (" + pkg.get("name") + ")"
+        log.info("Submitting package " + pkgid)
+        try:
+            return pkg.get("id"), pkgid, self.resubmit_pkg(pkg) or 0
+        except Exception:
+            log.exception("Error submitting package " + pkgid)
+            return pkg.get("id"), pkgid, None
+
+    def submit_all_pkgs(self, workers=1, resume=False, checkpoint_path=None):
+        """
+        Submits every package in the catalog. With --fg, packages are recorded
+        in the checkpoint file as they finish, and with `resume` the packages
+        already recorded there are skipped. In the background, a package is
+        only queued, not finished, so no checkpoint is kept.
+        """
+        checkpoint = None
+        completed = set()
+        if self.run_in_foreground:
+            checkpoint = Checkpoint(checkpoint_path or get_checkpoint_path(), resume)
+            completed = checkpoint.completed
+        elif resume or checkpoint_path:
+            log.warning(
+                "--resume and --checkpoint only apply with --fg; "
+                "submitting every package"
+            )
+        if completed:
+            log.info(
+                "Resuming: skipping {0} packages already submitted".format(
+                    len(completed)
+                )
+            )
+        packages = (
+            pkg for pkg in self.iter_all_pkgs() if pkg.get("id") not in completed
         )
+        if self.run_in_foreground and workers > 1:
+            results = submit_in_pool(packages, workers, self.force)
+        else:
+            results = (self.submit_pkg(pkg) for pkg in packages)
         total_pkg_count = 0
         total_res_count = 0
         total_pkg_failed_count = 0
         total_pkg_validated_count = 0
-        log.info("Found {0} packages".format(package_list.get("count", "bzzt")))
-        for pkg in package_list.get("results", []):
-            total_pkg_count += 1
-            pkgid = pkg.get("id") + " (" + pkg.get("name") + ")"
-            log.info("Validating package " + pkgid)
-            enqued = []
-            nenqued = []
-            try:
-                validated = self.identify_pkg(pkg.get("id", ""))
-            except Exception:
-                log.error("Error validating package " + pkgid)
-                validated = False
-            if validated:
-                log.info("Succesfully validated package and submitted " + pkgid)
-                res_count = self.resubmit_pkg(validated)
-                total_res_count += res_count if res_count else 0
-                total_pkg_validated_count += 1
-                enqued.append(pkgid)
-            else:
-                log.info("Unable to validate package " + pkg.get("id", ""))
-                nenqued.append(pkgid)
-                total_pkg_failed_count += 1
+        try:
+            for package_id, pkgid, res_count in results:
+                total_pkg_count += 1
+                if res_count is None:
+                    log.info("Unable to submit package " + pkgid)
+                    total_pkg_failed_count += 1
+                else:
+                    log.info("Succesfully submitted package " + pkgid)
+                    if checkpoint is not None:
+                        checkpoint.add(package_id)
+                    total_res_count += res_count
+                    total_pkg_validated_count += 1
+        finally:
+            if checkpoint is not None:
+                checkpoint.close()
         log.info(
-            "Total {} packages found. {} failed validation and did not submit. Submitted {} packages. {} total searchterm jobs".format(
+            "Total {} packages found. {} failed and did not submit. Submitted {} packages. {} total searchterm jobs".format(
                 total_pkg_count,
                 total_pkg_failed_count,
                 total_pkg_validated_count,
@@ -80,32 +157,156 @@ class SearchtermsCmd:
 
         total_eligible_resources = 0
 
-        for resource in package.get("resources", []):
-            if resource.get("name", "") == TERMS_RSRC_NAME:
-                log.info(
-                    "Deleting old search terms resource for package {0}".format(pkgid)
-                )
-                toolkit.get_action("package_revise")(
-                    site_user_context(),
-                    {
-                        "match__id": package.get("id"),
-                        "filter": ["-resources__{}".format(resource.get("id"))],
-                    },
-                )
-
+        # The old search terms resource is replaced by the job once the new
+        # terms are built, so the dataset stays searchable in the meantime
         log.info("Starting search terms job for package {0}".format(pkgid))
+        pending = []
         for resource in package.get("resources", []):
             rsrcid = resource.get("id") + " (" + resource.get("name") + ")"
+            if resource.get("name", "") == TERMS_RSRC_NAME:
+                continue
             if is_eligible(resource):
                 total_eligible_resources += 1
                 if self.run_in_foreground:
                     log.info("Checking search terms for resource " + rsrcid)
-                    check_search_terms_resource(resource, resource_was_updated=True)
+                    pending.append((resource, True))
                 else:
                     log.info("Enqueueing search terms job for resource " + rsrcid)
-                    enqueue_terms_job(resource, True)
+                    enqueue_terms_job(resource, True, rebuild=True, force=self.force)
             else:
                 log.debug("Skipping search terms job for resource " + rsrcid)
-        # a package should only ever have one active searchterms resource file
-        enqueue_xloader_searchterms(package.get("id"))
+        if pending:
+            update_package_search_terms(
+                package.get("id"), pending, rebuild=True, force=self.force
+            )
+        elif not total_eligible_resources:
+            # Nothing will replace the old search terms, so remove them now
+            self.delete_terms_resources(package)
         return total_eligible_resources
+
+    def delete_terms_resources(self, package):
+        terms_ids = [
+            resource.get("id")
+            for resource in package.get("resources", [])
+            if resource.get("name", "") == TERMS_RSRC_NAME
+        ]
+        if terms_ids:
+            log.info(
+                "Deleting old search terms resource for package {0}".format(
+                    package.get("id")
+                )
+            )
+            with package_lock(package.get("id")):
+                revise_search_terms(JobContext(), package.get("id"), drop_ids=terms_ids)
+
+    def reindex(self, dataset_spec):
+        """
+        Rebuilds the search index for one dataset or all of them, resolving
+        every package's search terms resource in one query beforehand.
+        """
+        if dataset_spec == "all":
+            package_ids = [
+                package_id
+                for (package_id,) in model.Session.query(model.Package.id).filter(
+                    model.Package.state == "active"
+                )
+            ]
+        else:
+            package = self.identify_pkg(dataset_spec)
+            if not package:
+                return
+            package_ids = [package.get("id")]
+
+        terms_resources = get_terms_resource_ids(
+            None if dataset_spec == "all" else package_ids
+        )
+        log.info(
+            "Reindexing {0} packages, {1} with search terms".format(
+                len(package_ids), len(terms_resources)
+            )
+        )
+        with batch_terms_resources(terms_resources):
+            search.rebuild(package_ids=package_ids, defer_commit=True)
+            search.commit()
+        return len(package_ids)
+
+    def stats(self, days=None):
+        """
+        Returns percentiles of the stage timings recorded by searchterms jobs,
+        optionally only for jobs that finished in the last `days` days.
+        """
+        query = model.Session.query(model.TaskStatus.value).filter(
+            model.TaskStatus.task_type == "searchterms"
+        )
+        if days:
+            since = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+            query = query.filter(model.TaskStatus.last_updated >= since)
+        return summarize_stages(value for (value,) in query)
+
+
+class Checkpoint:
+    """
+    The ids of the packages a `submit all` run has finished, appended to a
+    file one per line as they finish so that an interrupted run can resume.
+    Without `resume`, the file is started over.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.completed = set()
+        if resume and os.path.exists(path):
+            with open(path) as checkpoint_file:
+                self.completed = {line.strip() for line in checkpoint_file}
+            self.completed.discard("")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(path, "a" if resume else "w")
+
+    def add(self, package_id):
+        self._file.write(package_id + "\n")
+        self._file.flush()
+        self.completed.add(package_id)
+
+    def close(self):
+        self._file.close()
+
+
+def get_checkpoint_path():
+    return os.path.join(
+        os.environ["CKAN_STORAGE_PATH"], "searchterms", CHECKPOINT_FILENAME
+    )
+
+
+def init_pool_worker():
+    # Forked workers must not share the parent's database connections
+    model.Session.remove()
+    model.meta.engine.dispose()
+
+
+def submit_pkg_in_foreground(pkg, force):
+    return SearchtermsCmd(True, force).submit_pkg(pkg)
+
+
+def submit_in_pool(packages, workers, force=False):
+    """
+    Generates search terms for packages in a pool of `workers` processes,
+    yielding (package description, job count) as packages finish. Each
+    package is handled by one process, so its resources are processed in
+    order, and at most two packages per worker are queued at a time.
+    """
+    # Workers are forked so they inherit the loaded config and plugins. The
+    # parent's connections are closed first so none are shared with them.
+    model.Session.remove()
+    model.meta.engine.dispose()
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(
+        max_workers=workers, mp_context=context, initializer=init_pool_worker
+    ) as executor:
+        running = set()
+        for pkg in packages:
+            running.add(executor.submit(submit_pkg_in_foreground, pkg, force))
+            if len(running) >= workers * 2:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in as_completed(running):
+            yield future.result()
@@ -5,3 +5,11 @@ class SearchtermsParsingError(Exception):
     """
 
     pass
+
+
+class SearchtermsLockError(Exception):
+    """
+    Raised when a package's search terms lock could not be acquired in time
+    """
+
+    pass
@@ -0,0 +1,60 @@
+import logging
+from collections import Counter
+
+from ckan import model
+import ckan.plugins.toolkit as tk
+
+log = logging.getLogger(__name__)
+
+
+class JobContext:
+    """
+    State shared by the action calls of one searchterms job.
+
+    The site user and `package_show` results are fetched once per job and
+    reused; call `invalidate_package` after writing a package so the next
+    `package_show` sees the change. Every action called through the context
+    is counted in `action_calls`.
+    """
+
+    def __init__(self):
+        self._site_user = None
+        self._packages = {}
+        self.action_calls = Counter()
+        # Stages of the job timed with instrumentation.timed_stage
+        self.stages = {}
+
+    def call_action(self, action, context, data_dict):
+        self.action_calls[action] += 1
+        return tk.get_action(action)(context, data_dict)
+
+    def site_user_context(self):
+        # A new dict every time, since actions add their own keys to it
+        if self._site_user is None:
+            user = self.call_action(
+                "get_site_user", {"model": model, "ignore_auth": True}, {}
+            )
+            self._site_user = user["name"]
+        return {"ignore_auth": True, "user": self._site_user, "auth_user_obj": None}
+
+    def package_show(self, package_id):
+        if package_id not in self._packages:
+            self._packages[package_id] = self.call_action(
+                "package_show", self.site_user_context(), {"id": package_id}
+            )
+        return self._packages[package_id]
+
+    def invalidate_package(self, package_id):
+        self._packages.pop(package_id, None)
+
+    def log_action_calls(self, job_name):
+        log.info(
+            "{0} made {1} action calls: {2}".format(
+                job_name,
+                sum(self.action_calls.values()),
+                ", ".join(
+                    "{0}={1}".format(action, count)
+                    for action, count in sorted(self.action_calls.items())
+                ),
+            )
+        )
@@ -1,4 +1,7 @@
+from collections import namedtuple
+
 import ckan.plugins as p
+import ckan.plugins.toolkit as tk
 from ckanext.searchterms.interfaces import ISearchterms
 
 """
@@ -6,8 +9,97 @@ These methods are getters for the actual implementations in the consuming plugin
 
 Plugins should add their implementations using the interface
 `ckanext.searchterms.interfaces.ISearchterms`
+
+The implementations are looked up once, when they are first needed after the
+plugins are loaded, rather than on every call. How several implementers are
+combined is set by `ckanext.searchterms.composition`:
+
+- `last` (default): only the last plugin implementing each method is used.
+- `merge`: a resource is eligible if any implementer finds it eligible, and the
+  terms of every implementer that finds it eligible are concatenated, with
+  duplicate rows dropped.
+
+Jobs read terms with `iter_implementer_terms`, which streams the batches of
+implementers of the optional `iter_searchterms` method.
 """
 
+COMPOSITION = "ckanext.searchterms.composition"
+COMPOSITION_LAST = "last"
+COMPOSITION_MERGE = "merge"
+
+_implementations = None
+
+
+# terms_funcs holds (eligibility_func, terms_func, iter_func, version) of each
+# implementer, where either of terms_func and iter_func may be None. The
+# version identifies the implementers whose terms are used.
+Implementations = namedtuple(
+    "Implementations", ["composition", "eligibility_funcs", "terms_funcs", "version"]
+)
+
+
+def reset_implementations():
+    """
+    Forgets the resolved implementations, e.g. after the plugins are reloaded.
+    """
+    global _implementations
+    _implementations = None
+
+
+def get_implementations():
+    global _implementations
+    if _implementations is None:
+        composition = tk.config.get(COMPOSITION, COMPOSITION_LAST)
+        if composition not in (COMPOSITION_LAST, COMPOSITION_MERGE):
+            raise Exception(
+                "Invalid {0}: {1}. Use '{2}' or '{3}'.".format(
+                    COMPOSITION, composition, COMPOSITION_LAST, COMPOSITION_MERGE
+                )
+            )
+        eligibility_funcs = []
+        terms_funcs = []
+        for plugin in p.PluginImplementations(ISearchterms):
+            eligibility_func = getattr(plugin, "is_eligible_for_searchterms", None)
+            if eligibility_func is not None:
+                eligibility_funcs.append(eligibility_func)
+            terms_func = getattr(plugin, "get_searchterms", None)
+            iter_func = getattr(plugin, "iter_searchterms", None)
+            if terms_func is not None or iter_func is not None:
+                terms_funcs.append(
+                    (
+                        eligibility_func,
+                        terms_func,
+                        iter_func,
+                        get_plugin_version(plugin),
+                    )
+                )
+        if composition == COMPOSITION_LAST:
+            eligibility_funcs = eligibility_funcs[-1:]
+            terms_funcs = terms_funcs[-1:]
+        _implementations = Implementations(
+            composition,
+            eligibility_funcs,
+            terms_funcs,
+            ";".join(version for *_, version in terms_funcs),
+        )
+    return _implementations
+
+
+def get_plugin_version(plugin):
+    plugin_class = type(plugin)
+    version = ""
+    if hasattr(plugin, "get_searchterms_version"):
+        version = plugin.get_searchterms_version() or ""
+    return "{0}.{1}:{2}".format(plugin_class.__module__, plugin_class.__name__, version)
+
+
+def get_terms_version():
+    """
+    Returns a string identifying the implementers that generate search terms
+    and the versions they report, to tell whether stored terms are current.
+    """
+    return get_implementations().version
+
 
 def is_eligible(resource):
     """
@@ -15,30 +107,37 @@ def is_eligible(resource):
     that is used to determine if search terms should be calculated for the
     given resource
     """
+    eligibility_funcs = get_implementations().eligibility_funcs
+    if not eligibility_funcs:
+        raise Exception("No plugin implementing ISearchterms was found.")
 
-    eligibility_func = None
-    for plugin in p.PluginImplementations(ISearchterms):
-        if hasattr(plugin, "is_eligible_for_searchterms"):
-            eligibility_func = plugin.is_eligible_for_searchterms
+    # Stops at the first implementer that finds the resource eligible
+    return any(eligibility_func(resource) for eligibility_func in eligibility_funcs)
 
-    if eligibility_func is None:
-        raise Exception("No plugin implementing ISearchterms was found.")
 
-    return eligibility_func(resource)
+def iter_plugin_terms(terms_func, iter_func, resource, dataset, existing_terms):
+    if iter_func is not None:
+        yield from iter_func(resource, dataset, existing_terms)
+    else:
+        yield terms_func(resource, dataset, existing_terms)
 
 
-def get_terms(resource, dataset, existing_terms=None):
+def iter_implementer_terms(resource, dataset, existing_terms=None):
     """
-    Calls a function, `get_searchterms(resource, dataset, existing_terms) -> DataFrame`
-    that returns a dataframe of search terms
+    Yields, for each implementer whose terms are used for a resource, an
+    iterator of its search terms as DataFrames, a batch at a time, from its
+    `iter_searchterms`, or its `get_searchterms` as a single batch. With the
+    `merge` composition, every implementer that finds the resource eligible is
+    used in turn; see `jobs.collect_resource_terms` for how they are combined.
     """
-
-    eligibility_func = None
-    for plugin in p.PluginImplementations(ISearchterms):
-        if hasattr(plugin, "get_searchterms"):
-            eligibility_func = plugin.get_searchterms
-
-    if eligibility_func is None:
+    implementations = get_implementations()
+    if not implementations.terms_funcs:
         raise Exception("No plugin implementing ISearchterms was found.")
 
-    return eligibility_func(resource, dataset, existing_terms)
+    is_merge = implementations.composition == COMPOSITION_MERGE
+    for eligibility_func, terms_func, iter_func, _ in implementations.terms_funcs:
+        if is_merge and eligibility_func is not None and not eligibility_func(resource):
+            continue
+        yield iter_plugin_terms(
+            terms_func, iter_func, resource, dataset, existing_terms
+        )
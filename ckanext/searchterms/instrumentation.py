@@ -0,0 +1,85 @@
+import json
+import time
+import resource
+from contextlib import contextmanager
+
+import numpy as np
+
+"""
+Timing of the stages of searchterms jobs.
+
+Each stage records its wall time, the peak resident memory of the worker
+process when it ended and, where it applies, the number of rows it produced.
+Jobs store their stages in the `value` of each resource's searchterms
+task_status, under "stages", where `searchterms stats` reads them.
+"""
+
+STAGES_KEY = "stages"
+PERCENTILES = [50, 90, 99]
+
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def timed_stage(stages, name):
+    """
+    Times the `name` stage into the `stages` dict. Yields the stage's record,
+    to which a row count can be added as "rows". A stage that runs more than
+    once adds up its time and rows.
+    """
+    record = {}
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        seconds = time.perf_counter() - start
+        previous = stages.get(name, {})
+        record["seconds"] = round(previous.get("seconds", 0) + seconds, 3)
+        if "rows" in previous:
+            record["rows"] = previous["rows"] + record.get("rows", 0)
+        record["peak_rss_mb"] = round(get_peak_rss_mb(), 1)
+        stages[name] = record
+
+
+def get_task_stages(task_value):
+    """
+    Returns the stages recorded in a task_status value, or an empty dict.
+    """
+    try:
+        value = json.loads(task_value or "{}")
+    except ValueError:
+        return {}
+    if not isinstance(value, dict):
+        return {}
+    return value.get(STAGES_KEY) or {}
+
+
+def summarize_stages(task_values):
+    """
+    Returns, for each stage found in the given task_status values, the number
+    of jobs that recorded it and percentiles of its seconds, rows and peak
+    RSS, ordered by the total time spent in the stage.
+    """
+    samples = {}
+    for task_value in task_values:
+        for name, record in get_task_stages(task_value).items():
+            stage_samples = samples.setdefault(name, {})
+            for field in ["seconds", "rows", "peak_rss_mb"]:
+                if field in record:
+                    stage_samples.setdefault(field, []).append(record[field])
+
+    summary = []
+    for name, stage_samples in samples.items():
+        seconds = stage_samples.get("seconds", [])
+        stats = {"stage": name, "count": len(seconds), "total": float(sum(seconds))}
+        for field, values in stage_samples.items():
+            for percentile, result in zip(
+                PERCENTILES, np.percentile(values, PERCENTILES)
+            ):
+                stats["{0}_p{1}".format(field, percentile)] = float(result)
+            stats["{0}_max".format(field)] = float(max(values))
+        summary.append(stats)
+    return sorted(summary, key=lambda stats: stats["total"], reverse=True)
@@ -20,3 +20,22 @@ class ISearchterms(Interface):
         Multiple columns denotes synonyms.
         """
         return pd.DataFrame(["Dummy", "List"])
+
+    def iter_searchterms(self, resource, dataset, existing_terms):
+        """
+        Optional. Yields pandas.DataFrames of terms, in the same format as
+        get_searchterms, a batch at a time. Each batch is merged before the
+        next one is requested, so large resources can be parsed without
+        holding all of their terms in memory. By default, yields the result
+        of get_searchterms as a single batch.
+        """
+        yield self.get_searchterms(resource, dataset, existing_terms)
+
+    def get_searchterms_version(self):
+        """
+        Optional. Returns a string identifying the version of this plugin's
+        search terms output. Resources whose file and version have not changed
+        since their search terms were generated are not processed again, so
+        change it whenever the output of get_searchterms changes.
+        """
+        return ""
@@ -1,28 +1,70 @@
-import os
 import logging
-import pandas as pd
 import uuid
 import datetime
 import json
-from werkzeug.datastructures import FileStorage
+import numpy as np
+import pandas as pd
 import ckan.plugins.toolkit as tk
 import ckan.plugins as p
 import ckan.model as model
+from rq import get_current_job
+from .cache import get_index_cache, pipeline_write
 from .constants import SearchtermsParsingError
-from .implementations import is_eligible, get_terms
+from .context import JobContext
+from .implementations import get_terms_version, is_eligible, iter_implementer_terms
+from .instrumentation import STAGES_KEY, timed_stage
+from .terms_cache import get_cached_terms, set_cached_terms
+from .locks import package_lock
+from .prefix_index import (
+    is_prefix_index_enabled,
+    remove_prefix_index,
+    write_prefix_index,
+)
+from .scheduler import (
+    add_pending_resource,
+    claim_package_job,
+    claim_xloader_job,
+    drain_pending_resources,
+    release_package_job,
+    release_xloader_job,
+    wait_for_quiet_period,
+)
+from .storage import (
+    iter_search_terms_chunks,
+    read_search_terms,
+    remove_sidecar,
+    write_search_terms_file,
+    write_sidecar,
+)
 from .util import (
     BLANK,
+    MANIFEST_FIELD,
     SEARCHTERMS_ERROR,
+    TERMS_FILENAME,
     TERMS_RSRC_NAME,
     get_resource_file_path,
-    site_user_context,
+    get_resource_hash,
 )
 
+# Columns of per-row identifier hashes and resource counts, persisted in the
+# sidecar only
+KEY_COL = "_key"
+REFCOUNT_COL = "_refcount"
+INTERNAL_COLS = [KEY_COL, REFCOUNT_COL]
+
+# How the preview of searchterms resources is made: by submitting the TSV to
+# xloader, or by loading the table into the DataStore directly
+PREVIEW_LOADER = "ckanext.searchterms.preview_loader"
+PREVIEW_XLOADER = "xloader"
+PREVIEW_DATASTORE = "datastore"
+DATASTORE_BATCH_ROWS = "ckanext.searchterms.datastore_batch_rows"
+DEFAULT_DATASTORE_BATCH_ROWS = 10000
+
 log = logging.getLogger(__name__)
 
 
-# If resource is eligible, add terms job to worker queue
-def enqueue_terms_job(resource, resource_was_updated=False):
+# If resource is eligible, add it to its package's pending searchterms work
+def enqueue_terms_job(resource, resource_was_updated=False, rebuild=False, force=False):
     # Check package_id exists to make sure it's not a package
     if (
         resource.get("name") == TERMS_RSRC_NAME
@@ -45,19 +87,41 @@ def enqueue_terms_job(resource, resource_was_updated=False):
     p.toolkit.get_action("task_status_update")(
         {"session": model.meta.create_local_session(), "ignore_auth": True}, task
     )
+    package_id = resource.get("package_id")
+    job_id = None
+    is_new = False
     try:
-        job = tk.enqueue_job(
-            check_search_terms_resource,
-            [resource, resource_was_updated],
-            rq_kwargs={"timeout": 21600},
-            queue="searchterms",
-        )
+        options = [
+            option
+            for option, is_set in [("rebuild", rebuild), ("force", force)]
+            if is_set
+        ]
+        add_pending_resource(resource, resource_was_updated, options)
+        job_id, is_new = claim_package_job(package_id, str(uuid.uuid4()))
+        if is_new:
+            tk.enqueue_job(
+                check_search_terms_package,
+                [package_id],
+                rq_kwargs={"timeout": 21600, "job_id": job_id},
+                queue="searchterms",
+            )
+        else:
+            log.debug(
+                "Searchterms job {0} already scheduled for package {1}".format(
+                    job_id, package_id
+                )
+            )
     except Exception:
         log.exception("Unable to queue searchterms res_id=%s", res_id)
+        if is_new:
+            # Let the next resource added schedule the job instead
+            try:
+                release_package_job(package_id, job_id)
+            except Exception:
+                log.exception("Unable to release searchterms job %s", job_id)
 
-    package_id = resource.get("package_id")
     value = json.dumps(
-        {"job_id": job.id, "package_id": package_id, "resource_id": res_id}
+        {"job_id": job_id, "package_id": package_id, "resource_id": res_id}
     )
 
     task["value"] = value
@@ -80,62 +144,87 @@ def enqueue_terms_update_on_delete_job(resource):
 
 
 def get_existing_search_terms_df_from_csv(pkg):
+    """
+    Returns the package's existing searchterms as a DataFrame (or None), the id
+    of the searchterms resource it was read from, and the ids of all of the
+    package's searchterms resources. Unreadable searchterms resources are left
+    for the caller to remove with the rest.
+    """
     search_terms_df = None
     search_terms_resource_id = None
+    terms_resource_ids = []
     for rsc in pkg.get("resources"):
         if rsc.get("name") == TERMS_RSRC_NAME:
             log.debug("Found existing searchterms resource")
             filepath = get_resource_file_path(rsc.get("id"))
-            search_terms_resource_id = rsc.get("id")
+            terms_resource_ids.append(rsc.get("id"))
             try:
-                search_terms_df = pd.read_csv(filepath, sep="\t", dtype=str)
+                terms_df = read_search_terms(rsc.get("id"))
                 # Check for old schema
-                if "found_in_1" in search_terms_df.columns:
-                    log.info("Old schema detected; deleting old search terms resource")
-                    tk.get_action("package_revise")(
-                        site_user_context(),
-                        {
-                            "match__id": pkg.get("id"),
-                            "filter": ["-resources__{}".format(rsc.get("id"))],
-                        },
+                if "found_in_1" in terms_df.columns:
+                    log.info(
+                        "Old schema detected; discarding old search terms resource"
                     )
-                    return None, None
+                    continue
+                search_terms_df = terms_df
+                search_terms_resource_id = rsc.get("id")
             except UnicodeDecodeError:
                 log.error(
-                    "Existing searchterms resource is non-unicode. Deleting the resource."
-                )
-                tk.get_action("package_revise")(
-                    site_user_context(),
-                    {
-                        "match__id": pkg.get("id"),
-                        "filter": ["-resources__{}".format(rsc.get("id"))],
-                    },
+                    "Existing searchterms resource is non-unicode. Discarding the resource."
                 )
             except FileNotFoundError:
                 err_msg = (
                     "Search terms resource does not have a corresponding file to load "
                     "(File does not exist: {0}). "
-                    "Deleting the resource."
+                    "Discarding the resource."
                 )
                 log.error(err_msg.format(filepath))
-                tk.get_action("package_revise")(
-                    site_user_context(),
-                    {
-                        "match__id": pkg.get("id"),
-                        "filter": ["-resources__{}".format(rsc.get("id"))],
-                    },
-                )
-    return search_terms_df, search_terms_resource_id
+    return search_terms_df, search_terms_resource_id, terms_resource_ids
+
+
+def check_search_terms_package(package_id):
+    """
+    Runs once per package for all of its resources that were queued during the
+    debounce window, writing the package's searchterms file a single time.
+    """
+    wait_for_quiet_period(package_id)
+    pending, options = drain_pending_resources(package_id)
+    if not pending:
+        log.debug("No pending searchterms resources for package " + package_id)
+        return
+    log.info(
+        "Generating search terms for {0} resources of package {1}".format(
+            len(pending), package_id
+        )
+    )
+    job = JobContext()
+    update_package_search_terms(
+        package_id,
+        pending,
+        job,
+        rebuild="rebuild" in options,
+        force="force" in options,
+    )
+    job.log_action_calls("Searchterms job for package " + package_id)
 
 
 def check_search_terms_resource(resource, resource_was_updated=False):
     """
     Check for existing searchterms, update if it exists, otherwise create it
     """
+    job = JobContext()
+    searchterms_df = update_package_search_terms(
+        resource.get("package_id"), [(resource, resource_was_updated)], job
+    )
+    job.log_action_calls("Searchterms job for resource " + resource.get("id"))
+    return searchterms_df
+
+
+def start_task(job, res_id):
     # Retrieve the existing task_status for this resource's searchterms job
-    res_id = resource.get("id")
-    existing_task = p.toolkit.get_action("task_status_show")(
-        site_user_context(),
+    existing_task = job.call_action(
+        "task_status_show",
+        job.site_user_context(),
         {"entity_id": res_id, "task_type": "searchterms", "key": "searchterms"},
     )
 
@@ -151,63 +240,305 @@ def check_search_terms_resource(resource, resource_was_updated=False):
         "value": existing_task.get("value", ""),
         "error": "{}",
     }
-    p.toolkit.get_action("task_status_update")(
-        {"session": model.meta.create_local_session(), "ignore_auth": True}, task
+    job.call_action(
+        "task_status_update",
+        {"session": model.meta.create_local_session(), "ignore_auth": True},
+        task,
     )
+    return task
+
 
-    log = logging.getLogger(__name__)
+def finish_task(job, task, error=None, stages=None):
+    task["state"] = "error" if error else "complete"
+    if stages:
+        try:
+            value = json.loads(task.get("value") or "{}")
+        except ValueError:
+            value = {}
+        value[STAGES_KEY] = stages
+        task["value"] = json.dumps(value)
+    task["error"] = error or "{}"
+    task["last_updated"] = str(datetime.datetime.utcnow())
+    job.call_action(
+        "task_status_update",
+        {"session": model.meta.create_local_session(), "ignore_auth": True},
+        task,
+    )
+
+
+def update_package_search_terms(
+    package_id, pending, job=None, rebuild=False, force=False
+):
+    """
+    Generates search terms for each (resource, resource_was_updated) pair in
+    `pending`, merges them all into the package's existing searchterms and
+    saves the result once. With `rebuild`, the terms of resources that are no
+    longer eligible resources of the package are dropped as well. `job` is the
+    JobContext to make action calls through; a new one is used if it is not
+    given.
+
+    Resources whose file and plugin version match the searchterms manifest
+    are skipped, unless `force` is set. Errors other than a resource's parsing
+    errors are recorded on the resources' tasks and raised.
+    """
+    if job is None:
+        job = JobContext()
+    tasks = {}
+    # Stages timed for a single resource, in addition to the job's stages
+    resource_stages = {}
+    for resource, _ in pending:
+        tasks[resource.get("id")] = start_task(job, resource.get("id"))
+        resource_stages[resource.get("id")] = {}
 
     try:
-        dataset = tk.get_action("package_show")(
-            site_user_context(), {"id": resource.get("package_id")}
-        )
-        rsrc_id = resource.get("id")
-        rsrc_col = "rsrc-{}".format(rsrc_id)
+        # Hold the package lock from reading the existing terms until the new
+        # terms file is saved, so concurrent jobs cannot drop each other's terms
+        with package_lock(package_id):
+            with timed_stage(job.stages, "package_show"):
+                dataset = job.package_show(package_id)
 
-        searchterms_df = None
-        # Get the search terms resource as a DataFrame, if it exists
-        log.info(f"Generating search terms for resource {resource.get('name')}")
-        searchterms_df, _ = get_existing_search_terms_df_from_csv(dataset)
-        try:
-            new_terms_df = get_terms(resource, dataset, searchterms_df)
-            new_terms_df = create_initial_searchterms(rsrc_col, new_terms_df)
-        except SearchtermsParsingError as e:
-            add_error(resource, str(e))
-            raise Exception(
-                f"Error parsing search terms for resource {resource.get('name')}"
+            # Get the search terms resource as a DataFrame, if it exists
+            with timed_stage(job.stages, "load_existing") as stage:
+                (
+                    existing_df,
+                    searchterms_id,
+                    terms_resource_ids,
+                ) = get_existing_search_terms_df_from_csv(dataset)
+                stage["rows"] = 0 if existing_df is None else len(existing_df)
+            manifest = get_terms_manifest(dataset, searchterms_id)
+            version = get_terms_version()
+            # The existing terms stay in place until the new ones replace them
+            searchterms_df = existing_df
+            is_changed = False
+            if rebuild and existing_df is not None:
+                # A rebuild may be drained in several batches, so the terms of
+                # resources submitted in other batches are kept. Only those of
+                # resources the package no longer has, or that are no longer
+                # eligible, are dropped.
+                current = {
+                    "rsrc-{}".format(res.get("id"))
+                    for res in dataset.get("resources", [])
+                    if res.get("name") != TERMS_RSRC_NAME and is_eligible(res)
+                }
+                for rsrc_col in get_rsrccols(searchterms_df):
+                    if rsrc_col not in current:
+                        searchterms_df = remove_resource_from_search_terms(
+                            rsrc_col, searchterms_df
+                        )
+                        manifest.pop(rsrc_col, None)
+                        is_changed = True
+                pending = [(res, True) for res, _ in pending]
+            has_existing = searchterms_df is not None
+            if has_existing:
+                existing_indexcols = get_indexcols(searchterms_df)
+            is_merged = False
+            completed = []
+            errors = {}
+            for resource, resource_was_updated in pending:
+                rsrc_col = "rsrc-{}".format(resource.get("id"))
+                stages = resource_stages[resource.get("id")]
+                with timed_stage(stages, "hash"):
+                    content_hash = get_resource_hash(resource)
+                entry = {"hash": content_hash, "version": version}
+                if (
+                    not force
+                    and content_hash is not None
+                    and manifest.get(rsrc_col) == entry
+                    and has_existing
+                    and rsrc_col in searchterms_df.columns
+                ):
+                    log.info(
+                        f"Search terms for resource {resource.get('name')} are up to date"
+                    )
+                    finish_task(
+                        job, tasks[resource.get("id")], stages={**job.stages, **stages}
+                    )
+                    continue
+                log.info(f"Generating search terms for resource {resource.get('name')}")
+                new_terms_df = None
+                if not force and content_hash is not None:
+                    with timed_stage(stages, "terms_cache"):
+                        new_terms_df = get_cached_terms(content_hash, version)
+                try:
+                    if new_terms_df is not None:
+                        log.info("Reusing cached search terms")
+                        new_terms_df = create_initial_searchterms(
+                            rsrc_col, new_terms_df
+                        )
+                    else:
+                        implementer_batches = iter_implementer_terms(
+                            resource, dataset, get_public_terms(searchterms_df)
+                        )
+                        new_terms_df = collect_resource_terms(
+                            rsrc_col, implementer_batches, stages
+                        )
+                        if content_hash is not None:
+                            with timed_stage(stages, "terms_cache"):
+                                set_cached_terms(
+                                    content_hash,
+                                    version,
+                                    new_terms_df.drop(columns=[rsrc_col]),
+                                )
+                except SearchtermsParsingError as e:
+                    errors[resource.get("id")] = get_error_message(e)
+                    err_msg = f"Error parsing search terms for resource {resource.get('name')}"
+                    log.error("searchterms error: {0}".format(err_msg))
+                    finish_task(
+                        job,
+                        tasks[resource.get("id")],
+                        err_msg,
+                        {**job.stages, **stages},
+                    )
+                    continue
+                with timed_stage(stages, "merge") as stage:
+                    if searchterms_df is not None:
+                        if resource_was_updated and rsrc_col in searchterms_df.columns:
+                            searchterms_df = remove_resource_from_search_terms(
+                                rsrc_col, searchterms_df
+                            )
+                        searchterms_df = update_searchterms(
+                            rsrc_col, new_terms_df, searchterms_df
+                        )
+                        is_merged = True
+                    else:
+                        searchterms_df = new_terms_df
+                    stage["rows"] = len(searchterms_df)
+                if content_hash is None:
+                    manifest.pop(rsrc_col, None)
+                else:
+                    manifest[rsrc_col] = entry
+                completed.append(resource)
+
+            if not completed and not is_changed:
+                # Keep the existing terms, but drop any unusable terms resources
+                stale_ids = [
+                    res_id for res_id in terms_resource_ids if res_id != searchterms_id
+                ]
+                with timed_stage(job.stages, "revise"):
+                    revise_search_terms(
+                        job,
+                        package_id,
+                        drop_ids=stale_ids,
+                        errors=errors,
+                        searchterms_df=existing_df,
+                        searchterms_id=searchterms_id,
+                    )
+                return None
+            if is_merged:
+                new_column_order = [
+                    *get_identifiercols(searchterms_df),
+                    *get_termcols(searchterms_df),
+                    *get_rsrccols(searchterms_df),
+                    *[column for column in INTERNAL_COLS if column in searchterms_df],
+                ]
+                # search_index is rebuilt as the last column below
+                searchterms_df = searchterms_df[new_column_order]
+            # Unchanged rows keep their search_index if no columns were added
+            reuse_index = has_existing and get_indexcols(searchterms_df) == (
+                existing_indexcols
             )
-        if searchterms_df is not None:
-            if resource_was_updated and rsrc_col in searchterms_df.columns:
-                searchterms_df = remove_resource_from_search_terms(
-                    rsrc_col, searchterms_df
+            with timed_stage(job.stages, "search_index") as stage:
+                searchterms_df = add_search_index_to_search_terms(
+                    searchterms_df, reuse_existing=reuse_index
                 )
-            searchterms_df = update_searchterms(rsrc_col, new_terms_df, searchterms_df)
-            delete_existing_search_terms(resource)
-            new_column_order = [
-                *get_identifiercols(searchterms_df),
-                *get_termcols(searchterms_df),
-                *get_rsrccols(searchterms_df),
-                "search_index",
-            ]
-            searchterms_df = searchterms_df[new_column_order]
-        else:
-            searchterms_df = new_terms_df
-        searchterms_df = add_search_index_to_search_terms(searchterms_df)
-        save_file(searchterms_df, dataset.get("id"))
-
-        task["state"] = "complete"
-        task["error"] = "{}"
-        p.toolkit.get_action("task_status_update")(
-            {"session": model.meta.create_local_session(), "ignore_auth": True}, task
-        )
+                stage["rows"] = len(searchterms_df)
+            with timed_stage(job.stages, "save") as stage:
+                new_resource = save_file(searchterms_df, package_id, manifest)
+                stage["rows"] = len(searchterms_df)
+            # Includes reindexing the dataset
+            with timed_stage(job.stages, "revise"):
+                revise_search_terms(
+                    job,
+                    package_id,
+                    drop_ids=terms_resource_ids,
+                    new_resource=new_resource,
+                    errors=errors,
+                    searchterms_df=searchterms_df,
+                )
+
+        for resource in completed:
+            finish_task(
+                job,
+                tasks[resource.get("id")],
+                stages={**job.stages, **resource_stages[resource.get("id")]},
+            )
         return searchterms_df
     except Exception as e:
-        task["state"] = "error"
-        task["error"] = str(e)
         log.error("searchterms error: {0}".format(str(e)))
-        p.toolkit.get_action("task_status_update")(
-            {"session": model.meta.create_local_session(), "ignore_auth": True}, task
-        )
+        for res_id, task in tasks.items():
+            if task["state"] == "running":
+                finish_task(
+                    job, task, str(e), {**job.stages, **resource_stages[res_id]}
+                )
+        raise
+
+
+def get_public_terms(searchterms_df):
+    """
+    Returns the searchterms as plugins are given them, without the internal
+    columns read from the sidecar.
+    """
+    if searchterms_df is None:
+        return None
+    return searchterms_df.drop(
+        columns=[column for column in INTERNAL_COLS if column in searchterms_df]
+    )
+
+
+def collect_resource_terms(rsrc_col, implementer_batches, stages):
+    """
+    Builds a resource's searchterms from the batches of terms of each
+    implementer used for it (see `implementations.iter_implementer_terms`).
+    The terms of several implementers are concatenated with duplicate rows
+    dropped, so rows of different implementers that share identifiers are all
+    kept. The package's searchterms are left untouched until the resource is
+    complete.
+    """
+    resource_dfs = [
+        collect_implementer_terms(rsrc_col, batches, stages)
+        for batches in implementer_batches
+    ]
+    if not resource_dfs:
+        return create_initial_searchterms(rsrc_col, pd.DataFrame())
+    if len(resource_dfs) == 1:
+        return resource_dfs[0]
+    with timed_stage(stages, "merge"):
+        resource_df = pd.concat(resource_dfs, ignore_index=True, sort=False)
+        resource_df.fillna(value="", inplace=True)
+        return resource_df.drop_duplicates(ignore_index=True)
+
+
+def collect_implementer_terms(rsrc_col, batches, stages):
+    """
+    Builds a resource's searchterms from the batches of terms one implementer
+    yields. Each batch is upserted into the terms before the next one is
+    requested, so only one batch of raw terms is held at a time.
+    """
+    resource_df = None
+    while True:
+        # The consuming plugin's own time
+        with timed_stage(stages, "get_terms") as stage:
+            batch = next(batches, None)
+            stage["rows"] = 0 if batch is None else len(batch)
+        if batch is None:
+            break
+        batch = create_initial_searchterms(rsrc_col, batch)
+        with timed_stage(stages, "merge"):
+            if resource_df is None:
+                resource_df = batch
+            else:
+                keycols = get_keycols(resource_df)
+                if KEY_COL not in resource_df.columns and keycols:
+                    # The first batch may repeat identifiers, which later
+                    # batches can only be upserted into once they are unique
+                    keys = hash_rows(resource_df, keycols)
+                    resource_df = resource_df[~pd.Index(keys).duplicated()]
+                resource_df = update_searchterms(rsrc_col, batch, resource_df)
+    if resource_df is None:
+        return create_initial_searchterms(rsrc_col, pd.DataFrame())
+    # Row keys and counts are recomputed when merging into the package's terms
+    internal_cols = [column for column in INTERNAL_COLS if column in resource_df]
+    return resource_df.drop(columns=internal_cols)
 
 
 def create_initial_searchterms(rsrc_col, new_terms_df):
@@ -219,19 +550,88 @@ def create_initial_searchterms(rsrc_col, new_terms_df):
 
 def update_searchterms(rsrc_col, new_terms_df, searchterms_df):
     """
-    Merges new searchterms DataFrame into existing searchterms DataFrame.
+    Upserts new searchterms DataFrame into existing searchterms DataFrame, keyed
+    on a hash of the identifier columns they share.
 
     1) If these terms are already in the old searchterms DataFrame, _update_ them
-    3) If there are new terms not existing in the old searchterms DataFrame, _append_ them
+    2) If there are new terms not existing in the old searchterms DataFrame, _append_ them
+
+    The existing rows' keys are persisted in the searchterms sidecar, so only the
+    new terms are hashed and looked up.
     """
     log.info("Merging new searchterms with old searchterms")
 
-    new_terms_identifiers = get_identifiercols(new_terms_df)
-    searchterms_identifiers = get_identifiercols(searchterms_df)
-    ## merge lists of identifiers and deduplicate
+    new_terms_identifiers = get_keycols(new_terms_df)
     shared_identifiers = [
-        column for column in searchterms_identifiers if column in new_terms_identifiers
+        column
+        for column in get_keycols(searchterms_df)
+        if column in new_terms_identifiers
     ]
+    if not shared_identifiers:
+        log.info("No identifiers shared with existing searchterms; appending")
+        return append_searchterms(new_terms_df, searchterms_df)
+    existing_keys = get_row_keys(searchterms_df, shared_identifiers)
+    existing_index = pd.Index(existing_keys)
+    if not existing_index.is_unique:
+        log.info("Duplicate identifiers in existing searchterms; merging tables")
+        return merge_searchterms(new_terms_df, searchterms_df, shared_identifiers)
+
+    if KEY_COL in searchterms_df.columns:
+        searchterms_df.pop(KEY_COL)
+    refcounts = pop_refcounts(searchterms_df)
+    new_keys = hash_rows(new_terms_df, shared_identifiers)
+    is_first = ~pd.Index(new_keys).duplicated()
+    new_terms_df = new_terms_df[is_first]
+    new_keys = new_keys[is_first]
+
+    positions = existing_index.get_indexer(new_keys)
+    is_match = positions >= 0
+    matched_rows = positions[is_match]
+    if rsrc_col in searchterms_df.columns:
+        was_member = searchterms_df[rsrc_col].to_numpy()[matched_rows] == "True"
+        refcounts[matched_rows[~was_member]] += 1
+    else:
+        refcounts[matched_rows] += 1
+    # Columns only the new terms have, e.g. this resource's rsrc column
+    for column in new_terms_df.columns:
+        if column not in searchterms_df.columns:
+            searchterms_df[column] = ""
+            searchterms_df.iloc[
+                matched_rows, searchterms_df.columns.get_loc(column)
+            ] = new_terms_df[column].to_numpy()[is_match]
+    if rsrc_col in new_terms_df.columns:
+        searchterms_df.iloc[matched_rows, searchterms_df.columns.get_loc(rsrc_col)] = (
+            "True"
+        )
+
+    appended = new_terms_df[~is_match]
+    merged = pd.concat([searchterms_df, appended], ignore_index=True, sort=False)
+    merged.fillna(value="", inplace=True)
+    merged[REFCOUNT_COL] = np.concatenate([refcounts, count_resources(appended)])
+    if shared_identifiers == get_keycols(merged):
+        merged[KEY_COL] = np.concatenate([existing_keys, new_keys[~is_match]])
+    return merged
+
+
+def append_searchterms(new_terms_df, searchterms_df):
+    """
+    Appends new searchterms that share no identifying columns with the
+    existing searchterms, so none of their rows can be matched.
+    """
+    internal_cols = [column for column in INTERNAL_COLS if column in searchterms_df]
+    searchterms_df = searchterms_df.drop(columns=internal_cols)
+    merged = pd.concat([searchterms_df, new_terms_df], ignore_index=True, sort=False)
+    merged.fillna(value="", inplace=True)
+    return merged
+
+
+def merge_searchterms(new_terms_df, searchterms_df, shared_identifiers):
+    """
+    Merges new searchterms into existing searchterms with a full outer merge.
+    Used when the existing searchterms have duplicate identifiers.
+    """
+    internal_cols = [column for column in INTERNAL_COLS if column in searchterms_df]
+    searchterms_df = searchterms_df.drop(columns=internal_cols)
     merged = searchterms_df.merge(
         new_terms_df, how="outer", on=shared_identifiers, suffixes=(None, "_drop")
     )
@@ -244,166 +644,490 @@ def update_searchterms(rsrc_col, new_terms_df, searchterms_df):
     return merged
 
 
+def hash_rows(dataframe, columns):
+    """
+    Returns a uint64 hash of each row's values in `columns`. Blank and missing
+    values hash alike, since the TSV cannot tell them apart.
+    """
+    return pd.util.hash_pandas_object(
+        dataframe[columns].fillna(""), index=False
+    ).to_numpy()
+
+
+def get_row_keys(dataframe, columns):
+    """
+    Returns the row keys of a searchterms DataFrame for `columns`, reusing the
+    persisted key column when it was computed over the same columns.
+    """
+    if KEY_COL in dataframe.columns and columns == get_keycols(dataframe):
+        return dataframe[KEY_COL].to_numpy()
+    return hash_rows(dataframe, columns)
+
+
 # This method drops the column for a given resource ID from the searchterms table
-# But it first loops through all rows of the searchterms table, removing any if unused by other resources
+# Rows are reference counted by the number of resources they were found in, and
+# any row no longer found in another resource is removed with it
 def remove_resource_from_search_terms(rsrc_col, searchterms_df):
     log.info("Update detected - removing old search terms for this resource")
     rsrc_id = f"rsrc-{rsrc_col}" if "rsrc" not in rsrc_col else rsrc_col
+    if rsrc_id not in searchterms_df.columns:
+        return searchterms_df
+    refcounts = pop_refcounts(searchterms_df)
     # remove old column
-    searchterms_df.drop(columns=[rsrc_id], inplace=True)
+    refcounts -= searchterms_df.pop(rsrc_id).to_numpy() == "True"
     # drop any rows that should no longer exist because that column is gone
-    rsrc_cols = get_rsrccols(searchterms_df)
-    searchterms_df.dropna(how="all", subset=rsrc_cols, inplace=True)
+    is_orphan = refcounts <= 0
+    if is_orphan.any():
+        log.info("Removing {0} search terms rows".format(is_orphan.sum()))
+        searchterms_df = searchterms_df[~is_orphan].reset_index(drop=True)
+        refcounts = refcounts[~is_orphan]
+    searchterms_df[REFCOUNT_COL] = refcounts
     return searchterms_df
 
 
+def count_resources(dataframe):
+    """
+    Returns the number of resources each row of a searchterms DataFrame was
+    found in.
+    """
+    counts = np.zeros(len(dataframe), dtype=np.int32)
+    for column in get_rsrccols(dataframe):
+        counts += dataframe[column].to_numpy() == "True"
+    return counts
+
+
+def pop_refcounts(dataframe):
+    """
+    Removes and returns the persisted per-row resource counts of a searchterms
+    DataFrame, counting them from the rsrc columns if they are missing.
+    """
+    if REFCOUNT_COL in dataframe.columns:
+        return dataframe.pop(REFCOUNT_COL).to_numpy().astype(np.int32)
+    return count_resources(dataframe)
+
+
 def update_search_terms_on_delete(resource):
     log.debug("Updating searchterms because resource was deleted")
-    dataset = tk.get_action("package_show")(
-        site_user_context(), {"id": resource.get("package_id")}
-    )
+    package_id = resource.get("package_id")
+    job = JobContext()
+    try:
+        with package_lock(package_id):
+            dataset = job.package_show(package_id)
 
-    searchterms_df, searchterms_id = get_existing_search_terms_df_from_csv(dataset)
-    if searchterms_df is not None:
-        searchterms_df = remove_resource_from_search_terms(
-            resource.get("id"), searchterms_df
-        )
-        # Delete the old search_terms file
-        tk.get_action("package_revise")(
-            site_user_context(),
-            {
-                "match__id": resource.get("package_id"),
-                "filter": ["-resources__{}".format(searchterms_id)],
-            },
-        )
-    # Upload the new search_terms file (that has removed the old resource ID)
-    save_file(searchterms_df, dataset.get("id"))
-    return searchterms_df
+            (
+                searchterms_df,
+                searchterms_id,
+                terms_resource_ids,
+            ) = get_existing_search_terms_df_from_csv(dataset)
+            if searchterms_df is None:
+                revise_search_terms(job, package_id, drop_ids=terms_resource_ids)
+                return None
+            searchterms_df = remove_resource_from_search_terms(
+                resource.get("id"), searchterms_df
+            )
+            # Replace the old search_terms file with one that has removed the old resource ID
+            manifest = get_terms_manifest(dataset, searchterms_id)
+            new_resource = save_file(searchterms_df, package_id, manifest)
+            revise_search_terms(
+                job,
+                package_id,
+                drop_ids=terms_resource_ids,
+                new_resource=new_resource,
+                searchterms_df=searchterms_df,
+            )
+        return searchterms_df
+    finally:
+        job.log_action_calls("Searchterms delete job for package " + package_id)
 
 
-def save_file(searchterms_df, dataset_id):
-    # Write tmp file
-    log.info("Writing temporary searchterms file to disk")
-    tsv_filename = os.path.join("/tmp", "searchterms-{}".format(uuid.uuid4())) + ".tsv"
+def save_file(searchterms_df, dataset_id, manifest=None):
+    """
+    Writes the searchterms table straight into resource storage under a new
+    resource id, and returns the metadata of the resource to add to the dataset.
+    `manifest` maps resource columns to the file hash and plugin version their
+    terms were generated from.
+    """
+    resource_id = str(uuid.uuid4())
+    log.info("Writing searchterms file to resource storage")
     if "index" in searchterms_df.columns.values:
         searchterms_df.drop(columns=["index"], inplace=True)
     searchterms_df.fillna("", inplace=True)
-    searchterms_df.to_csv(tsv_filename, sep="\t", index=False, na_rep="")
-
-    # Upload tmp file to CKAN
-    upload_to_ckan(tsv_filename, TERMS_RSRC_NAME, dataset_id)
-
-    # Remove tmp file
-    os.remove(tsv_filename)
-
-
-def upload_to_ckan(filepath, name, dataset_id):
-    log.info("Uploading search terms file from disk to ckan")
-    with open(filepath, "rb") as file:
-        resource_metadata = {
-            "name": name,
-            "resource_file_type": "",
-            "package_id": dataset_id,
-        }
-        # TODO: move the file to its destination on the filesystem instead of uploading to the server
-        # Possibly by implementing get_resource_uploader()
-        pkg = tk.get_action("package_revise")(
-            site_user_context(),
+    keycols = get_keycols(searchterms_df)
+    if KEY_COL not in searchterms_df.columns and keycols:
+        searchterms_df[KEY_COL] = hash_rows(searchterms_df, keycols)
+    if REFCOUNT_COL not in searchterms_df.columns:
+        searchterms_df[REFCOUNT_COL] = count_resources(searchterms_df)
+    # Row keys and counts are only kept in the sidecar
+    tsv_columns = [
+        column for column in searchterms_df.columns if column not in INTERNAL_COLS
+    ]
+    size = write_search_terms_file(searchterms_df, resource_id, tsv_columns)
+    write_sidecar(searchterms_df, resource_id)
+
+    # The file is already in storage, so nothing passes through the uploader
+    return {
+        "id": resource_id,
+        "name": TERMS_RSRC_NAME,
+        "resource_file_type": "",
+        "package_id": dataset_id,
+        "url": TERMS_FILENAME,
+        "url_type": "upload",
+        "format": "TSV",
+        "mimetype": "text/tab-separated-values",
+        "size": size,
+        MANIFEST_FIELD: json.dumps(
             {
-                "match__id": dataset_id,
-                "update__resources__extend": [resource_metadata],
-                "update__resources__-1__upload": FileStorage(file),
-                "update": {SEARCHTERMS_ERROR: BLANK},
-            },
-        )
+                rsrc_col: entry
+                for rsrc_col, entry in (manifest or {}).items()
+                if rsrc_col in searchterms_df.columns
+            }
+        ),
+    }
+
+
+def revise_search_terms(
+    job,
+    dataset_id,
+    drop_ids=(),
+    new_resource=None,
+    errors=None,
+    searchterms_df=None,
+    searchterms_id=None,
+):
+    """
+    Applies all of a job's changes to the dataset in a single package_revise, so
+    the dataset is committed and reindexed once: dropping old searchterms
+    resources, adding the new one and setting or clearing `searchterms_error`.
+    `errors` maps resource ids to error messages.
+
+    `searchterms_df` is the table of the searchterms resource the dataset is
+    left with (the new one, or `searchterms_id`); the reindex takes its terms
+    from it instead of reading the file back.
+    """
+    revision = {"match__id": dataset_id}
+    if drop_ids:
+        for res_id in drop_ids:
+            log.info(
+                "Deleting existing searchterms resource file with resource id: {}".format(
+                    res_id
+                )
+            )
+        revision["filter"] = ["-resources__{}".format(res_id) for res_id in drop_ids]
+    if new_resource is not None:
+        revision["update__resources__extend"] = [new_resource]
+        revision["update"] = {SEARCHTERMS_ERROR: BLANK}
+    for res_id, message in (errors or {}).items():
+        revision["update__resources__{}".format(res_id)] = {SEARCHTERMS_ERROR: message}
+    if len(revision) == 1:
+        return None
+
+    # Any index payload cached for this package was built from the old file
+    get_index_cache().invalidate_package(dataset_id)
+    if new_resource is not None:
+        searchterms_id = new_resource["id"]
+    with pipeline_write(dataset_id, searchterms_id, searchterms_df):
+        pkg = job.call_action("package_revise", job.site_user_context(), revision)
+    job.invalidate_package(dataset_id)
+    if new_resource is not None:
+        check_manifest_saved(pkg, new_resource)
+    for res_id in drop_ids:
+        remove_sidecar(res_id)
+    if new_resource is None and searchterms_id is None:
+        # The dataset is left without search terms
+        remove_prefix_index(dataset_id)
+    if new_resource is not None:
         log.info(
-            "Created search terms resource for {} for dataset {}".format(
-                name, dataset_id
+            "Created search terms resource {} for dataset {}".format(
+                new_resource["id"], dataset_id
             )
         )
+        # Previewed once the job that wrote the terms has finished
+        current_job = get_current_job()
+        enqueue_xloader_searchterms(
+            dataset_id, depends_on=current_job.id if current_job else None
+        )
     return pkg
 
 
-def enqueue_xloader_searchterms(dataset_id):
-    tk.enqueue_job(
-        xloader_searchterms,
-        [dataset_id],
-        rq_kwargs={"timeout": 21600},
-        queue="searchterms",
-    )
+def check_manifest_saved(pkg, new_resource):
+    """
+    Warns if the manifest written to a new searchterms resource did not
+    persist, e.g. because the dataset schema does not declare it.
+    """
+    if json.loads(new_resource.get(MANIFEST_FIELD) or "{}") == {}:
+        return
+    for rsc in ((pkg or {}).get("package") or {}).get("resources", []):
+        if rsc.get("id") == new_resource["id"]:
+            if rsc.get(MANIFEST_FIELD) in (None, "", "{}"):
+                log.warning(
+                    "The {0} field of search terms resource {1} was not saved; "
+                    "add it to the resource fields of the dataset schema, or all "
+                    "resources will be reprocessed on every submission".format(
+                        MANIFEST_FIELD, new_resource["id"]
+                    )
+                )
+            return
+
+
+def enqueue_xloader_searchterms(dataset_id, depends_on=None):
+    # One xloader job per package is enough while one is still waiting to run.
+    # It reads the package when it starts, so it also covers terms written
+    # after it was queued.
+    try:
+        if not claim_xloader_job(dataset_id, depends_on):
+            return
+        rq_kwargs = {"timeout": 21600}
+        if depends_on is not None:
+            rq_kwargs["depends_on"] = depends_on
+        tk.enqueue_job(
+            xloader_searchterms,
+            [dataset_id],
+            rq_kwargs=rq_kwargs,
+            queue="searchterms",
+        )
+    except Exception:
+        # The terms are written either way; only their preview is missing
+        log.exception("Unable to queue xloader job for package %s", dataset_id)
 
 
 def xloader_searchterms(dataset_id):
-    pkg = tk.get_action("package_show")(site_user_context(), {"id": dataset_id})
+    release_xloader_job(dataset_id)
+    job = JobContext()
+    with timed_stage(job.stages, "package_show"):
+        pkg = job.package_show(dataset_id)
+    terms_resources = [
+        resource
+        for resource in pkg.get("resources", [])
+        if resource.get("name") == TERMS_RSRC_NAME and resource.get("state") == "active"
+    ]
+    # Built here rather than with the terms file, to keep it off the
+    # critical path and in step with the dataset's saved terms resource
+    if is_prefix_index_enabled() and terms_resources:
+        with timed_stage(job.stages, "prefix_index") as stage:
+            stage["rows"] = build_dataset_prefix_index(
+                dataset_id, terms_resources[-1].get("id")
+            )
     # Manually submit searchterms to xloader to make a preview available
-    for resource in pkg.get("resources", []):
-        if (
-            resource.get("name") == TERMS_RSRC_NAME
-            and resource.get("state") == "active"
-            and not resource.get("datastore_active")
-        ):
+    for resource in terms_resources:
+        if not resource.get("datastore_active"):
             resource_id = resource.get("id")
-            tk.get_action("xloader_submit")(
-                site_user_context(),
-                {"resource_id": resource_id, "ignore_hash": True},
-            )
+            if get_preview_loader() == PREVIEW_DATASTORE:
+                with timed_stage(job.stages, "datastore_load") as stage:
+                    stage["rows"] = load_search_terms_into_datastore(job, resource_id)
+                log.info(
+                    "Loaded {} search terms rows into the DataStore for dataset {}".format(
+                        stage["rows"], dataset_id
+                    )
+                )
+                continue
+            with timed_stage(job.stages, "xloader_submit"):
+                job.call_action(
+                    "xloader_submit",
+                    job.site_user_context(),
+                    {"resource_id": resource_id, "ignore_hash": True},
+                )
             log.info(
                 "Enqueued xloader job for search terms resource {} for dataset {}".format(
                     resource_id, dataset_id
                 )
             )
+    # Recorded on the package, as the terms resource has no task of its own
+    task_key = {"entity_id": dataset_id, "task_type": "searchterms", "key": "xloader"}
+    try:
+        existing_task = job.call_action(
+            "task_status_show", job.site_user_context(), task_key
+        )
+    except tk.ObjectNotFound:
+        existing_task = {}
+    task = {
+        "id": existing_task.get("id"),
+        "entity_id": dataset_id,
+        "entity_type": "package",
+        "task_type": "searchterms",
+        "last_updated": str(datetime.datetime.utcnow()),
+        "key": "xloader",
+        "value": "{}",
+    }
+    finish_task(job, task, stages=job.stages)
+    job.log_action_calls("Xloader searchterms job for package " + dataset_id)
 
 
-def delete_existing_search_terms(resource):
-    pkg = tk.get_action("package_show")(
-        site_user_context(), {"id": resource.get("package_id")}
-    )
-    # Get all searchterm resources in package
-    resources = [
-        res for res in pkg.get("resources") if res.get("name") == TERMS_RSRC_NAME
-    ]
-    # Build filter arguments for removing resources with package_revise
-    resource_filters = []
-    for resource in resources:
-        log.info(
-            "Deleting existing searchterms resource file with resource id: {}".format(
-                resource.get("id")
+def build_dataset_prefix_index(dataset_id, resource_id):
+    """
+    Writes the dataset's prefix index from the identifier and term columns of
+    its searchterms resource. Returns the number of rows read.
+    """
+    rows = 0
+
+    def iter_index_terms():
+        nonlocal rows
+        for chunk in iter_search_terms_chunks(
+            resource_id, DEFAULT_DATASTORE_BATCH_ROWS
+        ):
+            rows += len(chunk)
+            for term in chunk[get_indexcols(chunk)].values.ravel():
+                if isinstance(term, str):
+                    yield term
+
+    write_prefix_index(dataset_id, iter_index_terms())
+    return rows
+
+
+def get_preview_loader():
+    loader = tk.config.get(PREVIEW_LOADER, PREVIEW_XLOADER)
+    if loader not in (PREVIEW_XLOADER, PREVIEW_DATASTORE):
+        raise Exception(
+            "Invalid {0}: {1}. Use '{2}' or '{3}'.".format(
+                PREVIEW_LOADER, loader, PREVIEW_XLOADER, PREVIEW_DATASTORE
             )
         )
-        resource_filters.append("-resources__{}".format(resource.get("id")))
-    tk.get_action("package_revise")(
-        site_user_context(),
-        {
-            "match__id": pkg.get("id"),
-            "filter": resource_filters,
-        },
+    return loader
+
+
+def load_search_terms_into_datastore(job, resource_id):
+    """
+    Loads a searchterms resource's table into the DataStore in batches of
+    `ckanext.searchterms.datastore_batch_rows` records, reading the table
+    this extension wrote instead of having xloader download and parse the
+    TSV. Returns the number of rows loaded.
+    """
+    batch_rows = tk.asint(
+        tk.config.get(DATASTORE_BATCH_ROWS, DEFAULT_DATASTORE_BATCH_ROWS)
     )
+    rows = 0
+    try:
+        for batch in iter_datastore_batches(resource_id, batch_rows):
+            records = get_datastore_records(batch)
+            if rows == 0:
+                job.call_action(
+                    "datastore_create",
+                    job.site_user_context(),
+                    {
+                        "resource_id": resource_id,
+                        "force": True,
+                        "fields": get_datastore_fields(batch),
+                        "records": records,
+                    },
+                )
+            else:
+                job.call_action(
+                    "datastore_upsert",
+                    job.site_user_context(),
+                    {
+                        "resource_id": resource_id,
+                        "force": True,
+                        "method": "insert",
+                        "records": records,
+                    },
+                )
+            rows += len(records)
+    except Exception:
+        # A partial table would look complete, so the next job would skip it
+        try:
+            job.call_action(
+                "datastore_delete",
+                job.site_user_context(),
+                {"resource_id": resource_id, "force": True},
+            )
+        except Exception:
+            log.warning("Could not delete partial DataStore table of " + resource_id)
+        raise
+    return rows
+
+
+def iter_datastore_batches(resource_id, batch_rows):
+    for chunk in iter_search_terms_chunks(resource_id, batch_rows):
+        for start in range(0, len(chunk), batch_rows):
+            yield chunk.iloc[start : start + batch_rows]
+
+
+def get_datastore_fields(searchterms_df):
+    """
+    Returns the DataStore fields of a searchterms table: resource columns
+    are booleans and every other column is text. Row keys and counts are
+    not loaded, as in the TSV.
+    """
+    rsrc_cols = get_rsrccols(searchterms_df)
+    return [
+        {"id": column, "type": "bool" if column in rsrc_cols else "text"}
+        for column in searchterms_df.columns
+        if column not in INTERNAL_COLS
+    ]
 
 
-def add_search_index_to_search_terms(searchterms_df):
+def get_datastore_records(searchterms_df):
+    """
+    Returns the rows of a searchterms table as DataStore records of plain
+    Python values, matching `get_datastore_fields`.
+    """
+    rsrc_cols = get_rsrccols(searchterms_df)
+    columns = []
+    values = []
+    for column in searchterms_df.columns:
+        if column in INTERNAL_COLS:
+            continue
+        series = searchterms_df[column]
+        columns.append(column)
+        if column in rsrc_cols:
+            values.append((series == "True").tolist())
+        else:
+            values.append(series.fillna("").astype(str).tolist())
+    return [dict(zip(columns, row)) for row in zip(*values)]
+
+
+def add_search_index_to_search_terms(searchterms_df, reuse_existing=False):
     """
     adds a || separated string column to each row as a 'search_index' for use in the explorer tool
+
+    With `reuse_existing`, only rows with a blank search_index (e.g. newly appended
+    rows) are recomputed. Only pass it when the indexable columns have not changed
+    since the existing search_index was built.
     """
+    indexable_cols = get_indexcols(searchterms_df)
+    if reuse_existing and "search_index" in searchterms_df.columns:
+        search_index = searchterms_df.pop("search_index").fillna("")
+        is_stale = (search_index == "").to_numpy()
+        if is_stale.any():
+            search_index[is_stale] = join_columns(
+                searchterms_df.loc[is_stale, indexable_cols]
+            )
+        searchterms_df["search_index"] = search_index
+        return searchterms_df
     if "search_index" in searchterms_df.columns:
         searchterms_df.drop(columns=["search_index"], inplace=True)
-    indexable_cols = get_termcols(searchterms_df) + get_identifiercols(searchterms_df)
-    searchterms_df["search_index"] = searchterms_df[indexable_cols].agg(
-        "||".join, axis=1
-    )
+    searchterms_df["search_index"] = join_columns(searchterms_df[indexable_cols])
     return searchterms_df
 
 
-def add_error(resource, e):
-    errormessage = "Unable to process your resource for search. Error: {}".format(e)
-    resource[SEARCHTERMS_ERROR] = errormessage
-    res_id = resource.get("id")
-    tk.get_action("package_revise")(
-        site_user_context(),
-        {
-            "match__id": resource.get("package_id"),
-            f"update__resources__{res_id}": resource,
-        },
-    )
+def join_columns(dataframe, sep="||"):
+    """
+    Joins the string columns of a DataFrame row-wise with `sep`, one column at a
+    time rather than one row at a time. Missing values join as blanks.
+    """
+    columns = [dataframe[column].fillna("") for column in dataframe.columns]
+    if not columns:
+        return pd.Series("", index=dataframe.index)
+    return columns[0].str.cat(columns[1:], sep=sep)
+
+
+def get_terms_manifest(dataset, searchterms_id):
+    """
+    Returns the manifest stored on the dataset's searchterms resource: a dict
+    of resource column to the {"hash", "version"} its terms were made from.
+    """
+    for rsc in dataset.get("resources", []):
+        if searchterms_id is not None and rsc.get("id") == searchterms_id:
+            try:
+                manifest = json.loads(rsc.get(MANIFEST_FIELD) or "{}")
+            except ValueError:
+                log.warning("Ignoring invalid searchterms manifest")
+                return {}
+            return manifest if isinstance(manifest, dict) else {}
+    return {}
+
+
+def get_error_message(e):
+    return "Unable to process your resource for search. Error: {}".format(e)
 
 
 def get_termcols(dataframe):
@@ -414,8 +1138,27 @@ def get_identifiercols(dataframe):
     return [
         column
         for column in dataframe.columns.values.tolist()
-        if "rsrc" not in column and "Term" not in column
+        if "rsrc" not in column and "Term" not in column and column not in INTERNAL_COLS
+    ]
+
+
+def get_indexcols(dataframe):
+    return [
+        column
+        for column in get_termcols(dataframe) + get_identifiercols(dataframe)
+        if column != "search_index"
+    ]
+
+
+def get_keycols(dataframe):
+    """
+    Returns the columns identifying a row: the identifier columns, or the term
+    columns if there are none.
+    """
+    keycols = [
+        column for column in get_identifiercols(dataframe) if column != "search_index"
     ]
+    return keycols or get_termcols(dataframe)
 
 
 def get_rsrccols(dataframe):
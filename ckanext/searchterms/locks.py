@@ -0,0 +1,83 @@
+import os
+import time
+import fcntl
+import logging
+from contextlib import contextmanager
+
+import ckan.plugins.toolkit as tk
+from ckan.lib.redis import connect_to_redis
+from redis.exceptions import LockError, RedisError
+
+from .constants import SearchtermsLockError
+
+"""
+Per-package locks around the read-merge-write cycle of a package's search
+terms, so several searchterms workers can run without losing each other's
+updates. Redis locks are used when Redis is reachable, otherwise an exclusive
+file lock under the storage path, which only coordinates workers on one host.
+"""
+
+LOCK_TIMEOUT = "ckanext.searchterms.lock_timeout"
+LOCK_WAIT = "ckanext.searchterms.lock_wait"
+# A lock expires after the job timeout in case its worker dies
+DEFAULT_LOCK_TIMEOUT = 21600
+DEFAULT_LOCK_WAIT = 21600
+FILE_LOCK_POLL_SECONDS = 0.5
+
+log = logging.getLogger(__name__)
+
+
+@contextmanager
+def package_lock(package_id):
+    """
+    Holds an exclusive lock on the package's search terms for the duration of
+    the block. Raises SearchtermsLockError if it is not acquired within
+    `ckanext.searchterms.lock_wait` seconds.
+    """
+    timeout = tk.asint(tk.config.get(LOCK_TIMEOUT, DEFAULT_LOCK_TIMEOUT))
+    wait = tk.asint(tk.config.get(LOCK_WAIT, DEFAULT_LOCK_WAIT))
+    try:
+        conn = connect_to_redis()
+        conn.ping()
+    except RedisError:
+        log.warning("Redis unavailable; using a file lock for package " + package_id)
+        with _file_lock(package_id, wait):
+            yield
+        return
+
+    name = "{0}:searchterms:lock:{1}".format(tk.config.get("ckan.site_id"), package_id)
+    lock = conn.lock(name, timeout=timeout, blocking_timeout=wait)
+    if not lock.acquire():
+        raise SearchtermsLockError(
+            "Timed out waiting for the search terms lock of package " + package_id
+        )
+    try:
+        yield
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            log.warning("Search terms lock of package {0} expired".format(package_id))
+
+
+@contextmanager
+def _file_lock(package_id, wait):
+    lock_dir = os.path.join(os.environ["CKAN_STORAGE_PATH"], "searchterms", "locks")
+    os.makedirs(lock_dir, exist_ok=True)
+    deadline = time.time() + wait
+    with open(os.path.join(lock_dir, package_id + ".lock"), "w") as lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    raise SearchtermsLockError(
+                        "Timed out waiting for the search terms lock of package "
+                        + package_id
+                    )
+                time.sleep(FILE_LOCK_POLL_SECONDS)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,25 +1,30 @@
-import math
 import json
 import logging
+from contextlib import contextmanager
 from os.path import exists
 
 from ckan import plugins
 import ckan.plugins.toolkit as tk
-import pandas as pd
 
-from .jobs import (
-    enqueue_terms_job,
-    enqueue_terms_update_on_delete_job,
-    enqueue_xloader_searchterms,
-)
+from .cache import file_identity, get_index_cache, get_pipeline_write
+from .implementations import reset_implementations
+from .jobs import enqueue_terms_job, enqueue_terms_update_on_delete_job
+from .storage import get_search_terms_source, iter_search_terms_chunks
 from .util import (
     TERMS_RSRC_NAME,
     get_resource_file_path,
-    site_user_context,
 )
 
+INDEX_FIELD = "ckanext.searchterms.index_field"
+INDEX_MAX_TERMS = "ckanext.searchterms.index_max_terms"
+# Rows read from a search terms file at a time while building the index
+INDEX_CHUNK_ROWS = 10000
+TERMS_PER_KEY = 100
+
 log = logging.getLogger(__name__)
 
+_batch_terms_resources = None
+
 
 def package_has_resource_type(package, resource_type):
     ret_val = False
@@ -30,11 +35,193 @@ def package_has_resource_type(package, resource_type):
     return ret_val
 
 
+def is_valid_string(value):
+    return isinstance(value, str) and value.strip() not in [
+        "True",
+        "False",
+        "",
+    ]
+
+
+def iter_valid_terms(chunks):
+    """
+    Streams the valid terms of a search terms table in row order from an
+    iterable of DataFrame chunks, so memory use does not grow with the file.
+    """
+    for chunk in chunks:
+        for item in chunk.values.ravel():
+            if is_valid_string(item):
+                yield item
+
+
+def iter_term_slices(terms, size=TERMS_PER_KEY):
+    """
+    Groups an iterable of terms into lists of at most `size` terms.
+    """
+    data_slice = []
+    for term in terms:
+        data_slice.append(term)
+        if len(data_slice) == size:
+            yield data_slice
+            data_slice = []
+    if data_slice:
+        yield data_slice
+
+
+def iter_unique_terms(terms):
+    """
+    Yields each term once with surrounding and repeated whitespace collapsed,
+    comparing terms case-insensitively.
+    """
+    seen = set()
+    for term in terms:
+        term = " ".join(term.split())
+        key = term.casefold()
+        if key not in seen:
+            seen.add(key)
+            yield term
+
+
+def build_chunked_payload(package_id, terms):
+    """
+    Returns `extras_<package id>_search_term_<i>` keys holding JSON lists of
+    100 terms each.
+    """
+    payload = {}
+    for i, data_slice in enumerate(iter_term_slices(terms)):
+        key = package_id + "_search_term_" + str(i)
+        payload["extras_" + key] = json.dumps(data_slice)
+    return payload
+
+
+def build_field_payload(package_id, terms, index_field, max_terms=0):
+    """
+    Returns a single multi-valued `index_field` holding the package's
+    deduplicated terms, keeping at most `max_terms` of them (0 for no limit).
+    """
+    chunked_bytes = 0
+
+    def measured(terms):
+        nonlocal chunked_bytes
+        for term in terms:
+            # Size of the term inside a chunked extra: quoted, plus ", "
+            chunked_bytes += len(json.dumps(term)) + 2
+            yield term
+
+    unique_terms = []
+    dropped = 0
+    for term in iter_unique_terms(measured(terms)):
+        if max_terms and len(unique_terms) >= max_terms:
+            dropped += 1
+        else:
+            unique_terms.append(term)
+
+    field_bytes = sum(len(term) for term in unique_terms)
+    log.info(
+        "Indexing {0} unique terms for package {1} in {2}: {3} bytes, "
+        "{4} bytes less than chunked extras".format(
+            len(unique_terms),
+            package_id,
+            index_field,
+            field_bytes,
+            chunked_bytes - field_bytes,
+        )
+    )
+    if dropped:
+        log.warning(
+            "Dropped {0} terms for package {1} over the limit of {2}".format(
+                dropped, package_id, max_terms
+            )
+        )
+    return {index_field: unique_terms}
+
+
+def get_payload_size(payload):
+    """
+    Returns the approximate size of an index payload in bytes: the length of
+    its strings.
+    """
+    size = 0
+    for key, value in payload.items():
+        size += len(key)
+        if isinstance(value, str):
+            size += len(value)
+        else:
+            size += sum(len(term) for term in value)
+    return size
+
+
+def build_index_payload(package_id, chunks):
+    """
+    Reads a search terms table and returns the keys to add to the package's
+    index document: chunked `extras_` keys by default, or one multi-valued
+    field when `ckanext.searchterms.index_field` is set.
+    """
+    terms = iter_valid_terms(chunks)
+    index_field = tk.config.get(INDEX_FIELD)
+    if index_field:
+        max_terms = tk.asint(tk.config.get(INDEX_MAX_TERMS, 0))
+        return build_field_payload(package_id, terms, index_field, max_terms)
+    return build_chunked_payload(package_id, terms)
+
+
+@contextmanager
+def batch_terms_resources(terms_resources):
+    """
+    Makes before_dataset_index look up terms resources in a mapping of
+    package id to terms resource id resolved up front (see
+    `util.get_terms_resource_ids`) instead of decoding each package's data.
+    Packages missing from the mapping are indexed without search terms.
+    """
+    global _batch_terms_resources
+    _batch_terms_resources = terms_resources
+    try:
+        yield
+    finally:
+        _batch_terms_resources = None
+
+
+def get_terms_resource_id(pkg_dict):
+    """
+    Returns the id of the package's search terms resource using only the
+    data being indexed. CKAN removes `resources` from the index document
+    before calling plugins, so they are read from the serialized package.
+    """
+    if _batch_terms_resources is not None:
+        return _batch_terms_resources.get(pkg_dict.get("id"))
+    resources = pkg_dict.get("resources")
+    if resources is None:
+        data_dict = pkg_dict.get("validated_data_dict") or pkg_dict.get("data_dict")
+        resources = json.loads(data_dict).get("resources", []) if data_dict else []
+    for rsrc in resources:
+        if rsrc.get("name") == TERMS_RSRC_NAME:
+            return rsrc.get("id")
+    return None
+
+
+def get_pipeline_chunks(package_id, terms_id):
+    """
+    Returns the search terms table as a single chunk if it is being written
+    by a searchterms job in this thread, so the job's own package_revise does
+    not parse the file again. Returns None otherwise.
+    """
+    write = get_pipeline_write(package_id)
+    if write is None:
+        return None
+    write_terms_id, searchterms_df = write
+    if write_terms_id != terms_id or searchterms_df is None:
+        return None
+    log.debug("Indexing search terms of package {0} from the job".format(package_id))
+    return [searchterms_df]
+
+
 class SearchtermsPlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IResourceController, inherit=True)
     plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.IClick)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
 
     # IResourceController
     def before_resource_update(self, context, current, resource):
@@ -43,14 +230,13 @@ class SearchtermsPlugin(plugins.SingletonPlugin):
             if resource.get("upload", False):
                 context["file_uploaded"] = True
 
+    # The preview of the terms is queued by the job once it writes them
     def after_resource_create(self, context, resource):
         enqueue_terms_job(resource)
-        enqueue_xloader_searchterms(resource.get("package_id"))
 
     def after_resource_update(self, context, resource):
         if context.get("file_uploaded"):
             enqueue_terms_job(resource)
-            enqueue_xloader_searchterms(resource.get("package_id"))
 
     # doesn't actually run for some reason
     def before_resource_delete(self, context, resource, resources):
@@ -58,45 +244,32 @@ class SearchtermsPlugin(plugins.SingletonPlugin):
 
     # IPackageController
     def before_dataset_index(self, pkg_dict):
-        pkg = tk.get_action("package_show")(
-            site_user_context(), {"id": pkg_dict.get("id")}
-        )
-        filteredResources = list(
-            filter(
-                lambda rsrc: rsrc.get("name") == TERMS_RSRC_NAME,
-                pkg.get("resources", []),
-            )
-        )
-        if len(filteredResources):
-
-            def is_valid_string(value):
-                return isinstance(value, str) and value.strip() not in [
-                    "True",
-                    "False",
-                    "",
-                ]
-
-            fpath = get_resource_file_path(filteredResources[0].get("id"))
+        terms_id = get_terms_resource_id(pkg_dict)
+        if terms_id:
+            fpath = get_resource_file_path(terms_id)
             if exists(fpath):
                 try:
-                    df = pd.read_csv(fpath, sep="\t", dtype=str)
-                    all_data = df.values.flatten().tolist()
-                    data = [item for item in all_data if is_valid_string(item)]
-                    hundreds = math.ceil(len(data) / float(100))
-                    for i in range(int(hundreds)):
-
-                        def upper_bound(proposed, max_len=len(data)):
-                            return max_len if proposed > max_len else proposed
-
-                        key = pkg.get("id") + "_search_term_" + str(i)
-                        min = int(i * 100)
-                        max = upper_bound((i + 1) * 100)
-                        data_slice = data[min:max]
-                        pkg_dict["extras_" + key] = json.dumps(data_slice)
-
+                    cache = get_index_cache()
+                    source = get_search_terms_source(terms_id)
+                    key = (terms_id, source, *file_identity(source))
+                    payload = cache.get(key)
+                    if payload is None:
+                        chunks = get_pipeline_chunks(pkg_dict.get("id"), terms_id)
+                        if chunks is None:
+                            chunks = iter_search_terms_chunks(
+                                terms_id, INDEX_CHUNK_ROWS
+                            )
+                        payload = build_index_payload(pkg_dict.get("id"), chunks)
+                        cache.set(
+                            key,
+                            payload,
+                            package_id=pkg_dict.get("id"),
+                            size=get_payload_size(payload),
+                        )
+                    pkg_dict.update(payload)
                 except Exception:
                     err_msg = "An error occurred in building the index for package {0}"
-                    log.error(err_msg.format(pkg.get("name")))
+                    log.error(err_msg.format(pkg_dict.get("name")))
                     raise
             else:
                 # Happens when resource is created, package updated with metadata, but file not uploaded yet
@@ -108,6 +281,8 @@ class SearchtermsPlugin(plugins.SingletonPlugin):
     # Adds templates from the plugin to the CKAN instance
     def update_config(self, config_):
         tk.add_template_directory(config_, "templates")
+        # The set of loaded plugins may have changed
+        reset_implementations()
 
     #######################################################################
     # IClick                                                              #
@@ -117,3 +292,15 @@ class SearchtermsPlugin(plugins.SingletonPlugin):
         from .click import get_commands
 
         return get_commands()
+
+    # IActions
+    def get_actions(self):
+        from .actions import get_actions
+
+        return get_actions()
+
+    # IAuthFunctions
+    def get_auth_functions(self):
+        from .auth import get_auth_functions
+
+        return get_auth_functions()
@@ -0,0 +1,156 @@
+import os
+
+import numpy as np
+
+import ckan.plugins.toolkit as tk
+
+from .cache import LRUCache, file_identity
+from .storage import atomic_path
+
+"""
+Prefix indexes of each dataset's search terms, for autocomplete and lookup.
+
+With `ckanext.searchterms.prefix_index` enabled, the job that follows each
+new terms file (see `jobs.xloader_searchterms`) writes the dataset's unique
+terms, sorted, to CKAN_STORAGE_PATH/searchterms/prefix/<dataset id>.npy.
+Indexes are per dataset; there is no catalog-wide index. The file is a single
+uint8 array: the number of terms n, n + 1 int64 offsets, then the entries,
+each the normalized term, a NUL byte and the term as it appears in the table.
+It is memory-mapped, and terms starting with a prefix are found by binary
+search, so a lookup reads only a few pages of the file.
+"""
+
+PREFIX_INDEX = "ckanext.searchterms.prefix_index"
+INDEX_SUFFIX = ".npy"
+HEADER = np.dtype("<i8")
+# Memory-mapped indexes kept open
+OPEN_INDEXES = 256
+
+_indexes = LRUCache(OPEN_INDEXES)
+
+
+def normalize_term(term):
+    return " ".join(term.split()).casefold()
+
+
+def is_prefix_index_enabled():
+    return tk.asbool(tk.config.get(PREFIX_INDEX, False))
+
+
+def get_prefix_index_dir():
+    return os.path.join(os.environ["CKAN_STORAGE_PATH"], "searchterms", "prefix")
+
+
+def get_prefix_index_path(package_id):
+    return os.path.join(get_prefix_index_dir(), package_id + INDEX_SUFFIX)
+
+
+def build_prefix_index(terms):
+    """
+    Returns the prefix index of an iterable of terms as a uint8 array. Terms
+    that normalize to the same key are kept once, as first seen.
+    """
+    entries = {}
+    for term in terms:
+        term = " ".join(term.split())
+        key = normalize_term(term)
+        if key and key not in entries:
+            entries[key] = (key + "\0" + term).encode()
+    # UTF-8 bytes sort in code point order, as prefixes are compared below
+    encoded = sorted(entries.values())
+    offsets = np.zeros(len(encoded) + 1, dtype=HEADER)
+    np.cumsum([len(entry) for entry in encoded], out=offsets[1:])
+    header = np.concatenate([[len(encoded)], offsets]).astype(HEADER)
+    return np.concatenate(
+        [header.view(np.uint8), np.frombuffer(b"".join(encoded), dtype=np.uint8)]
+    )
+
+
+def write_prefix_index(package_id, terms):
+    """
+    Writes the prefix index of a dataset's terms, replacing any existing one
+    atomically.
+    """
+    with atomic_path(get_prefix_index_path(package_id)) as tmp_path:
+        # np.save would add .npy to a path without it
+        with open(tmp_path, "wb") as f:
+            np.save(f, build_prefix_index(terms))
+    _indexes.invalidate_package(package_id)
+
+
+def remove_prefix_index(package_id):
+    path = get_prefix_index_path(package_id)
+    if os.path.exists(path):
+        os.remove(path)
+    _indexes.invalidate_package(package_id)
+
+
+class PrefixIndex:
+    """
+    A memory-mapped prefix index written by `write_prefix_index`.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        size = HEADER.itemsize
+        self._count = int(data[:size].view(HEADER)[0])
+        self._offsets = data[size : size * (self._count + 2)].view(HEADER)
+        self._base = size * (self._count + 2)
+
+    def __len__(self):
+        return self._count
+
+    def _entry(self, i):
+        start = self._base + self._offsets[i]
+        return self._data[start : self._base + self._offsets[i + 1]].tobytes()
+
+    def _lower_bound(self, key):
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def iter_prefix(self, prefix):
+        """
+        Yields the terms whose normalized form starts with `prefix`, in order.
+        """
+        key = normalize_term(prefix).encode()
+        for i in range(self._lower_bound(key), self._count):
+            entry = self._entry(i)
+            if not entry.startswith(key):
+                break
+            yield entry.split(b"\0", 1)[1].decode()
+
+    def find(self, term):
+        """
+        Returns the term as indexed if its normalized form is in the index,
+        otherwise None.
+        """
+        key = normalize_term(term).encode() + b"\0"
+        i = self._lower_bound(key)
+        if i < self._count:
+            entry = self._entry(i)
+            if entry.startswith(key):
+                return entry[len(key) :].decode()
+        return None
+
+
+def get_prefix_index(package_id):
+    """
+    Returns the dataset's prefix index, or None if it has none. Opened indexes
+    are reused until their file is rewritten.
+    """
+    path = get_prefix_index_path(package_id)
+    try:
+        key = (path, file_identity(path))
+    except FileNotFoundError:
+        return None
+    index = _indexes.get(key)
+    if index is None:
+        index = PrefixIndex(np.load(path, mmap_mode="r"))
+        _indexes.set(key, index, package_id=package_id)
+    return index
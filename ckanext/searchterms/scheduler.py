@@ -0,0 +1,199 @@
+import json
+import time
+import logging
+
+import ckan.plugins.toolkit as tk
+from ckan.lib.redis import connect_to_redis
+from redis.exceptions import WatchError
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+"""
+Coalesces searchterms work per package.
+
+Resources waiting for search terms are collected in a Redis hash per package,
+and only one package job is scheduled at a time. The job waits until no new
+resources have arrived for the debounce window, then takes every pending
+resource at once so the package's terms file is rebuilt a single time.
+
+Pending resources do not expire, since a queued job may wait behind a long
+backfill; they are only removed by the job that takes them. A claim whose job
+has failed or no longer exists is taken over by the next resource added.
+"""
+
+DEBOUNCE_SECONDS = "ckanext.searchterms.debounce_seconds"
+DEFAULT_DEBOUNCE_SECONDS = 5
+# Upper bound on how long a job waits for uploads to stop arriving
+MAX_DEBOUNCE_WAIT = 60
+# xloader claims expire in case a job is lost, matching the job timeout
+SCHEDULED_TTL = 21600
+FAILED_JOB_STATUSES = ("failed", "stopped", "canceled")
+
+log = logging.getLogger(__name__)
+
+
+def _key(kind, package_id):
+    return "{0}:searchterms:{1}:{2}".format(
+        tk.config.get("ckan.site_id"), kind, package_id
+    )
+
+
+def get_debounce_seconds():
+    return tk.asint(tk.config.get(DEBOUNCE_SECONDS, DEFAULT_DEBOUNCE_SECONDS))
+
+
+def add_pending_resource(resource, resource_was_updated=False, options=()):
+    """
+    Records a resource as waiting for search terms in its package. If the
+    resource is already pending, its latest dict is kept and the update flag
+    is combined with the earlier one. `options` names flags that apply to the
+    next package job, e.g. "rebuild" or "force" (see
+    `jobs.update_package_search_terms`).
+    """
+    conn = connect_to_redis()
+    package_id = resource.get("package_id")
+    pending_key = _key("pending", package_id)
+    existing = conn.hget(pending_key, resource.get("id"))
+    if existing:
+        resource_was_updated = resource_was_updated or json.loads(existing)["updated"]
+    pipe = conn.pipeline()
+    pipe.hset(
+        pending_key,
+        resource.get("id"),
+        json.dumps({"resource": resource, "updated": resource_was_updated}),
+    )
+    pipe.set(_key("last_added", package_id), time.time(), ex=SCHEDULED_TTL)
+    if options:
+        pipe.sadd(_key("options", package_id), *options)
+    pipe.execute()
+
+
+def claim_package_job(package_id, job_id):
+    """
+    Marks a package job as scheduled. Returns the id of the job that will pick
+    up the package's pending resources, and whether it is `job_id` (i.e. the
+    caller must enqueue it). The claim of a job that failed or no longer
+    exists is taken over.
+    """
+    conn = connect_to_redis()
+    scheduled_key = _key("scheduled", package_id)
+    if conn.set(scheduled_key, job_id, nx=True):
+        return job_id, True
+    # A job claimed but not yet enqueued can also be taken over; the extra
+    # job then finds nothing pending and returns
+    scheduled = take_over_claim(conn, scheduled_key, job_id)
+    if scheduled is None:
+        return job_id, True
+    return (scheduled or job_id), False
+
+
+def release_package_job(package_id, job_id):
+    """
+    Clears the package's scheduled marker if it is still held by `job_id`,
+    e.g. when the job could not be enqueued.
+    """
+    conn = connect_to_redis()
+    scheduled_key = _key("scheduled", package_id)
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(scheduled_key)
+            if pipe.get(scheduled_key) != job_id.encode():
+                return
+            pipe.multi()
+            pipe.delete(scheduled_key)
+            pipe.execute()
+        except WatchError:
+            # Claimed again in the meantime
+            pass
+
+
+def wait_for_quiet_period(package_id):
+    """
+    Sleeps until no resource has been added to the package for the debounce
+    window, or MAX_DEBOUNCE_WAIT has passed.
+    """
+    debounce = get_debounce_seconds()
+    if debounce <= 0:
+        return
+    conn = connect_to_redis()
+    deadline = time.time() + MAX_DEBOUNCE_WAIT
+    while True:
+        last_added = float(conn.get(_key("last_added", package_id)) or 0)
+        remaining = min(last_added + debounce, deadline) - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(remaining)
+
+
+def drain_pending_resources(package_id):
+    """
+    Takes every pending resource of the package and clears the scheduled
+    marker in one transaction, so resources added afterwards schedule a new
+    job. Returns a list of (resource, resource_was_updated) tuples and the set
+    of options requested for the job.
+    """
+    conn = connect_to_redis()
+    pending_key = _key("pending", package_id)
+    options_key = _key("options", package_id)
+    pipe = conn.pipeline(transaction=True)
+    pipe.hgetall(pending_key)
+    pipe.smembers(options_key)
+    pipe.delete(pending_key, options_key, _key("scheduled", package_id))
+    pending, options, _ = pipe.execute()
+    entries = [json.loads(value) for value in pending.values()]
+    resources = [(entry["resource"], entry["updated"]) for entry in entries]
+    return resources, {option.decode() for option in options}
+
+
+def claim_xloader_job(package_id, depends_on=None):
+    """
+    Returns True if no xloader job is scheduled for the package yet, marking
+    one as scheduled. `depends_on` is the id of the job the xloader job will
+    wait for. If a waiting xloader job's dependency has failed, rq will never
+    run it, so its claim is taken over.
+    """
+    conn = connect_to_redis()
+    key = _key("xloader", package_id)
+    value = depends_on or ""
+    if conn.set(key, value, nx=True, ex=SCHEDULED_TTL):
+        return True
+    return take_over_claim(conn, key, value, ex=SCHEDULED_TTL) is None
+
+
+def take_over_claim(conn, key, value, ex=None):
+    """
+    Sets a claim `key` to `value` if the job id it holds has failed. Returns
+    None if the claim was taken over, otherwise the job id it holds ("" if
+    none).
+    """
+    with conn.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            claimed = pipe.get(key)
+            job_id = claimed.decode() if claimed else ""
+            if not job_id or not is_failed_job(job_id, conn):
+                return job_id
+            log.info("Job {0} failed; taking over its claim {1}".format(job_id, key))
+            pipe.multi()
+            pipe.set(key, value, ex=ex)
+            pipe.execute()
+            return None
+        except WatchError:
+            # Another job claimed it first
+            claimed = conn.get(key)
+            return claimed.decode() if claimed else ""
+
+
+def is_failed_job(job_id, conn):
+    """
+    Returns True if the job failed, was stopped or no longer exists.
+    """
+    try:
+        status = Job.fetch(job_id, connection=conn).get_status()
+    except NoSuchJobError:
+        return True
+    return status in FAILED_JOB_STATUSES
+
+
+def release_xloader_job(package_id):
+    connect_to_redis().delete(_key("xloader", package_id))
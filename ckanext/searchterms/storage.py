@@ -0,0 +1,195 @@
+import os
+import uuid
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from .util import get_resource_file_path
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+"""
+Columnar sidecars for search terms files.
+
+Next to each searchterms TSV, an uncompressed Arrow IPC (Feather v2) copy of
+the same table is written. It can be memory-mapped and read without parsing
+text, so jobs and the indexer read it instead of the TSV. The TSV remains the
+resource users download and xloader loads. Sidecars are skipped when pyarrow
+is not installed, in which case everything reads the TSV as before.
+
+A sidecar records the size and modification time of the TSV it was written
+with, and is removed when they no longer match, e.g. after the searchterms
+resource's file is uploaded again, so the TSV is read instead.
+"""
+
+SIDECAR_SUFFIX = ".arrow"
+# Schema metadata keys for the TSV a sidecar was written with
+TSV_SIZE_KEY = b"searchterms.tsv_size"
+TSV_MTIME_KEY = b"searchterms.tsv_mtime_ns"
+
+log = logging.getLogger(__name__)
+
+
+def get_sidecar_path(resource_id):
+    return get_resource_file_path(resource_id) + SIDECAR_SUFFIX
+
+
+def get_tsv_identity(resource_id):
+    """
+    Returns the schema metadata identifying the resource's TSV as it is now.
+    """
+    stat = os.stat(get_resource_file_path(resource_id))
+    return {
+        TSV_SIZE_KEY: str(stat.st_size).encode(),
+        TSV_MTIME_KEY: str(stat.st_mtime_ns).encode(),
+    }
+
+
+def has_sidecar(resource_id):
+    """
+    Returns True if the resource has a sidecar written with its current TSV.
+    A sidecar that no longer matches the TSV is removed.
+    """
+    if pa is None:
+        return False
+    path = get_sidecar_path(resource_id)
+    try:
+        with pa.memory_map(path) as source:
+            metadata = pa.ipc.open_file(source).schema.metadata or {}
+    except FileNotFoundError:
+        return False
+    except pa.ArrowException:
+        metadata = {}
+    try:
+        identity = get_tsv_identity(resource_id)
+    except FileNotFoundError:
+        return False
+    if all(metadata.get(key) == value for key, value in identity.items()):
+        return True
+    log.info("Removing searchterms sidecar that does not match its TSV " + path)
+    remove_sidecar(resource_id)
+    return False
+
+
+@contextmanager
+def atomic_path(path):
+    """
+    Yields a temporary path next to `path` to write to, then moves it into
+    place in one step, so readers never see a partially written file.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{0}.{1}.tmp".format(path, uuid.uuid4())
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_search_terms_file(searchterms_df, resource_id, columns):
+    """
+    Writes `columns` of the searchterms table as the TSV file of the given
+    searchterms resource, directly in resource storage. Returns its size.
+    """
+    path = get_resource_file_path(resource_id)
+    with atomic_path(path) as tmp_path:
+        searchterms_df.to_csv(
+            tmp_path, sep="\t", index=False, na_rep="", columns=columns
+        )
+    return os.path.getsize(path)
+
+
+def write_sidecar(searchterms_df, resource_id):
+    """
+    Writes the searchterms table as the Arrow sidecar of the given searchterms
+    resource, replacing any existing one atomically. The resource's TSV must
+    already be written.
+    """
+    if pa is None:
+        return
+    if not all(isinstance(column, str) for column in searchterms_df.columns):
+        log.debug("Not writing searchterms sidecar: column names must be strings")
+        return
+    table = pa.Table.from_pandas(
+        searchterms_df.reset_index(drop=True), preserve_index=False
+    )
+    table = table.replace_schema_metadata(
+        {**(table.schema.metadata or {}), **get_tsv_identity(resource_id)}
+    )
+    with atomic_path(get_sidecar_path(resource_id)) as tmp_path:
+        feather.write_feather(table, tmp_path, compression="uncompressed")
+
+
+def read_sidecar(resource_id):
+    """
+    Returns the searchterms table from the resource's Arrow sidecar, with
+    blank cells as NaN like `pd.read_csv` gives for the TSV, or None if there
+    is no sidecar.
+    """
+    if not has_sidecar(resource_id):
+        return None
+    table = feather.read_table(get_sidecar_path(resource_id), memory_map=True)
+    searchterms_df = table.to_pandas()
+    return searchterms_df.replace("", np.nan)
+
+
+def iter_sidecar_batches(resource_id):
+    """
+    Yields the sidecar table as DataFrames of one record batch each, so the
+    whole table is never held in memory at once.
+    """
+    with pa.memory_map(get_sidecar_path(resource_id)) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i).to_pandas()
+
+
+def iter_search_terms_chunks(resource_id, chunksize):
+    """
+    Yields the searchterms table of a searchterms resource as DataFrames,
+    one sidecar record batch or `chunksize` TSV rows at a time.
+    """
+    if has_sidecar(resource_id):
+        return iter_sidecar_batches(resource_id)
+    return pd.read_csv(
+        get_resource_file_path(resource_id), sep="\t", dtype=str, chunksize=chunksize
+    )
+
+
+def get_search_terms_source(resource_id):
+    """
+    Returns the path of the file `iter_search_terms_chunks` reads.
+    """
+    if has_sidecar(resource_id):
+        return get_sidecar_path(resource_id)
+    return get_resource_file_path(resource_id)
+
+
+def read_search_terms(resource_id):
+    """
+    Returns the searchterms table of a searchterms resource, from its sidecar
+    if there is one and otherwise from the TSV.
+    """
+    filepath = get_resource_file_path(resource_id)
+    # The TSV is the resource itself; a sidecar without it is stale
+    if not os.path.exists(filepath):
+        raise FileNotFoundError(filepath)
+    searchterms_df = read_sidecar(resource_id)
+    if searchterms_df is None:
+        searchterms_df = pd.read_csv(filepath, sep="\t", dtype=str)
+    return searchterms_df
+
+
+def remove_sidecar(resource_id):
+    try:
+        os.remove(get_sidecar_path(resource_id))
+    except FileNotFoundError:
+        # Removed by another reader
+        pass
@@ -0,0 +1,112 @@
+import os
+import hashlib
+import logging
+
+import ckan.plugins.toolkit as tk
+
+from .storage import atomic_path
+
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
+"""
+On-disk cache of the search terms generated for each resource.
+
+Terms are stored as Feather files under CKAN_STORAGE_PATH/searchterms/terms,
+keyed by the hash of the resource's file and the implementers' version (see
+`util.get_resource_hash` and `implementations.get_terms_version`), so
+rebuilding a package's table reuses the terms of unchanged files instead of
+calling the plugin again. The least recently used files are removed when the
+cache grows over `ckanext.searchterms.terms_cache_size` MB. The cache is
+disabled when pyarrow is not installed.
+
+This assumes a plugin's terms depend only on the resource's file, not on
+the existing terms it is given.
+"""
+
+TERMS_CACHE_SIZE = "ckanext.searchterms.terms_cache_size"
+DEFAULT_TERMS_CACHE_SIZE = 1024
+CACHE_SUFFIX = ".feather"
+
+log = logging.getLogger(__name__)
+
+
+def get_max_bytes():
+    return tk.asint(tk.config.get(TERMS_CACHE_SIZE, DEFAULT_TERMS_CACHE_SIZE)) * 2**20
+
+
+def is_enabled():
+    return feather is not None and get_max_bytes() > 0
+
+
+def get_cache_dir():
+    return os.path.join(os.environ["CKAN_STORAGE_PATH"], "searchterms", "terms")
+
+
+def get_cache_path(content_hash, version):
+    key = hashlib.sha256("{0}\0{1}".format(content_hash, version).encode()).hexdigest()
+    return os.path.join(get_cache_dir(), key + CACHE_SUFFIX)
+
+
+def get_cached_terms(content_hash, version):
+    """
+    Returns the cached terms for a file hash and version, or None.
+    """
+    if not is_enabled():
+        return None
+    path = get_cache_path(content_hash, version)
+    try:
+        terms_df = feather.read_feather(path)
+        # The file's modification time orders the cache for eviction
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        log.warning("Ignoring unreadable cached search terms " + path)
+        return None
+    return terms_df
+
+
+def set_cached_terms(content_hash, version, terms_df):
+    """
+    Caches the terms generated for a file hash and version, then evicts the
+    least recently used entries over the size limit.
+    """
+    if not is_enabled():
+        return
+    try:
+        with atomic_path(get_cache_path(content_hash, version)) as tmp_path:
+            feather.write_feather(terms_df.reset_index(drop=True), tmp_path)
+    except Exception as e:
+        # e.g. columns of mixed types Arrow cannot store
+        log.debug("Not caching search terms: {0}".format(e))
+        return
+    evict(get_max_bytes())
+
+
+def evict(max_bytes):
+    """
+    Removes the least recently used cache files until they take up at most
+    `max_bytes`.
+    """
+    entries = []
+    with os.scandir(get_cache_dir()) as scan:
+        for entry in scan:
+            if entry.name.endswith(CACHE_SUFFIX):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Already evicted by another worker
+            pass
+        total -= size
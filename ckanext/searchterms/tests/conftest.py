@@ -0,0 +1,12 @@
+"""Fixtures shared by the searchterms tests and benchmarks."""
+
+import pytest
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """
+    Points resource storage at a temporary directory.
+    """
+    monkeypatch.setenv("CKAN_STORAGE_PATH", str(tmp_path))
+    return tmp_path
@@ -0,0 +1,43 @@
+"""Tests for cache.py."""
+
+from ckanext.searchterms.cache import LRUCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_lru_cache_invalidates_by_package():
+    cache = LRUCache(10)
+    cache.set(("rsrc-1", 10, 1), {"x": 1}, package_id="pkg-1")
+    cache.set(("rsrc-2", 10, 1), {"y": 1}, package_id="pkg-2")
+    cache.invalidate_package("pkg-1")
+    assert cache.get(("rsrc-1", 10, 1)) is None
+    assert cache.get(("rsrc-2", 10, 1)) == {"y": 1}
+
+
+def test_lru_cache_disabled_with_zero_size():
+    cache = LRUCache(0)
+    cache.set("a", 1)
+    assert len(cache) == 0
+
+
+def test_lru_cache_evicts_over_maxbytes():
+    cache = LRUCache(10, maxbytes=100)
+    cache.set("a", 1, size=60)
+    cache.set("b", 2, size=30)
+    cache.set("c", 3, size=30)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.nbytes == 60
+    # Larger than the whole cache
+    cache.set("d", 4, size=101)
+    assert cache.get("d") is None
+    assert cache.get("c") == 3
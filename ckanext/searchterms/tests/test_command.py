@@ -0,0 +1,78 @@
+"""Tests for command.py."""
+
+import ckan.plugins.toolkit as toolkit
+
+import ckanext.searchterms.command as command
+
+
+def test_iter_all_pkgs_pages_through_the_catalog(monkeypatch):
+    """
+    Verify that every package is yielded once when the catalog is larger
+    than a package_search page
+    """
+    catalog = [{"id": str(i), "name": "pkg-{0}".format(i)} for i in range(5)]
+    searches = []
+
+    def package_search(context, data_dict):
+        searches.append(data_dict)
+        start, rows = data_dict["start"], data_dict["rows"]
+        return {"count": len(catalog), "results": catalog[start : start + rows]}
+
+    monkeypatch.setattr(command, "PAGE_SIZE", 2)
+    monkeypatch.setattr(toolkit, "get_action", lambda action: package_search)
+    cmd = command.SearchtermsCmd(False)
+    assert list(cmd.iter_all_pkgs()) == catalog
+    assert [search["start"] for search in searches] == [0, 2, 4]
+
+
+def test_checkpoint_resumes_with_completed_packages(tmp_path):
+    """
+    Verify that a resumed checkpoint holds the packages recorded before, and
+    that a new run starts the checkpoint over
+    """
+    path = str(tmp_path / "searchterms" / "submit_all.checkpoint")
+    checkpoint = command.Checkpoint(path)
+    checkpoint.add("pkg-1")
+    checkpoint.add("pkg-2")
+    checkpoint.close()
+    resumed = command.Checkpoint(path, resume=True)
+    assert resumed.completed == {"pkg-1", "pkg-2"}
+    resumed.close()
+    restarted = command.Checkpoint(path)
+    assert restarted.completed == set()
+    restarted.close()
+
+
+def test_submit_pkg_reports_failed_foreground_jobs(monkeypatch):
+    """
+    Verify that a package whose job fails has no job count, so it is not
+    recorded in the checkpoint
+    """
+
+    def update_package_search_terms(*args, **kwargs):
+        raise ValueError("Plugin failed")
+
+    monkeypatch.setattr(command, "is_eligible", lambda resource: True)
+    monkeypatch.setattr(
+        command, "update_package_search_terms", update_package_search_terms
+    )
+    pkg = {"id": "1", "name": "pkg-1", "resources": [{"id": "r1", "name": "r1"}]}
+    assert command.SearchtermsCmd(True).submit_pkg(pkg) == ("1", "1 (pkg-1)", None)
+
+
+def test_submit_all_keeps_no_checkpoint_in_background(tmp_path, monkeypatch):
+    """
+    Verify that queued packages are not recorded as finished, and that a
+    foreground run records the packages it finishes
+    """
+    catalog = [{"id": "1", "name": "pkg-1", "resources": []}]
+    monkeypatch.setattr(
+        toolkit,
+        "get_action",
+        lambda action: lambda context, data_dict: {"count": 1, "results": catalog},
+    )
+    path = tmp_path / "submit_all.checkpoint"
+    command.SearchtermsCmd(False).submit_all_pkgs(checkpoint_path=str(path))
+    assert not path.exists()
+    command.SearchtermsCmd(True).submit_all_pkgs(checkpoint_path=str(path))
+    assert path.read_text() == "1\n"
@@ -0,0 +1,24 @@
+"""Tests for context.py."""
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.searchterms.context import JobContext
+
+
+def test_job_context_memoizes_site_user_and_packages(monkeypatch):
+    """
+    Verify that the site user and package_show are fetched once per job,
+    that invalidating a package refetches it, and that calls are counted
+    """
+    actions = {
+        "get_site_user": lambda context, data_dict: {"name": "site"},
+        "package_show": lambda context, data_dict: {"id": data_dict["id"]},
+    }
+    monkeypatch.setattr(tk, "get_action", lambda action: actions[action])
+    job = JobContext()
+    assert job.package_show("pkg") == {"id": "pkg"}
+    assert job.package_show("pkg") == {"id": "pkg"}
+    assert job.site_user_context()["user"] == "site"
+    job.invalidate_package("pkg")
+    job.package_show("pkg")
+    assert job.action_calls == {"get_site_user": 1, "package_show": 2}
@@ -0,0 +1,138 @@
+"""Tests for implementations.py."""
+
+import pandas as pd
+import pytest
+
+import ckan.plugins.toolkit as tk
+
+import ckanext.searchterms.implementations as implementations
+from ckanext.searchterms.jobs import collect_resource_terms
+
+
+class FruitPlugin:
+    def is_eligible_for_searchterms(self, resource):
+        return resource["format"] == "CSV"
+
+    def get_searchterms(self, resource, dataset, existing_terms):
+        return pd.DataFrame({"Term": ["apple", "pear"]})
+
+
+class VegetablePlugin:
+    def is_eligible_for_searchterms(self, resource):
+        return True
+
+    def get_searchterms(self, resource, dataset, existing_terms):
+        return pd.DataFrame({"Term": ["pear", "leek"]})
+
+
+@pytest.fixture
+def use_plugins(monkeypatch):
+    def use(*plugins):
+        monkeypatch.setattr(
+            implementations.p, "PluginImplementations", lambda interface: plugins
+        )
+        implementations.reset_implementations()
+
+    yield use
+    implementations.reset_implementations()
+
+
+@pytest.fixture
+def merge_composition(monkeypatch):
+    monkeypatch.setitem(
+        tk.config, implementations.COMPOSITION, implementations.COMPOSITION_MERGE
+    )
+
+
+def get_terms(resource, column="Term"):
+    """
+    Returns a column of the terms a job collects for a resource.
+    """
+    implementer_batches = implementations.iter_implementer_terms(resource, {})
+    return collect_resource_terms("rsrc-1", implementer_batches, {})[column].tolist()
+
+
+def test_merge_composition_concatenates_eligible_implementers(
+    use_plugins, merge_composition
+):
+    """
+    Verify that merge composition is eligible if any implementer is, and
+    concatenates the deduplicated terms of the eligible implementers only
+    """
+    use_plugins(FruitPlugin(), VegetablePlugin())
+    csv = {"format": "CSV"}
+    pdf = {"format": "PDF"}
+    assert implementations.is_eligible(pdf) is True
+    assert get_terms(csv) == ["apple", "pear", "leek"]
+    assert get_terms(pdf) == ["pear", "leek"]
+
+
+class GenePlugin:
+    def __init__(self, terms):
+        self.terms = terms
+
+    def is_eligible_for_searchterms(self, resource):
+        return True
+
+    def iter_searchterms(self, resource, dataset, existing_terms):
+        for gene_id, term in self.terms:
+            yield pd.DataFrame({"gene_id": [gene_id], "Term": [term]})
+
+
+def test_merge_composition_keeps_rows_sharing_identifiers(
+    use_plugins, merge_composition
+):
+    """
+    Verify that rows of different implementers with the same identifiers are
+    all kept, rather than upserted over each other
+    """
+    use_plugins(
+        GenePlugin([("g1", "apple"), ("g2", "pear")]),
+        GenePlugin([("g1", "malus"), ("g2", "pear")]),
+    )
+    assert get_terms({}, "gene_id") == ["g1", "g2", "g1"]
+    assert get_terms({}) == ["apple", "pear", "malus"]
+
+
+def test_last_composition_uses_last_implementer(use_plugins):
+    """
+    Verify that by default only the last implementer is used
+    """
+    use_plugins(FruitPlugin(), VegetablePlugin())
+    assert get_terms({"format": "CSV"}) == ["pear", "leek"]
+
+
+class StreamingPlugin:
+    def is_eligible_for_searchterms(self, resource):
+        return True
+
+    def iter_searchterms(self, resource, dataset, existing_terms):
+        for term in ["a", "b"]:
+            yield pd.DataFrame({"Term": [term]})
+
+
+def test_iter_implementer_terms_streams_batches(use_plugins):
+    """
+    Verify that iter_searchterms batches are yielded one at a time, and that
+    they are collected into one DataFrame
+    """
+    use_plugins(StreamingPlugin())
+    (batches,) = implementations.iter_implementer_terms({}, {})
+    assert next(batches)["Term"].tolist() == ["a"]
+    assert next(batches)["Term"].tolist() == ["b"]
+    assert get_terms({}) == ["a", "b"]
+
+
+class EligibilityPlugin:
+    def is_eligible_for_searchterms(self, resource):
+        return True
+
+
+def test_last_composition_versions_the_terms_implementer(use_plugins):
+    """
+    Verify that the version is that of the plugin whose terms are used, not
+    of a later plugin that only implements eligibility
+    """
+    use_plugins(FruitPlugin(), EligibilityPlugin())
+    version = implementations.get_terms_version()
+    assert version == implementations.get_plugin_version(FruitPlugin())
@@ -0,0 +1,34 @@
+"""Tests for instrumentation.py."""
+
+import json
+
+from ckanext.searchterms.instrumentation import summarize_stages, timed_stage
+
+
+def test_timed_stage_adds_up_repeated_stages():
+    stages = {}
+    with timed_stage(stages, "merge") as stage:
+        stage["rows"] = 10
+    with timed_stage(stages, "merge") as stage:
+        stage["rows"] = 5
+    assert stages["merge"]["rows"] == 15
+    assert stages["merge"]["seconds"] >= 0
+    assert stages["merge"]["peak_rss_mb"] > 0
+
+
+def test_summarize_stages_percentiles():
+    """
+    Verify that stages are summarized across task values, skipping values
+    without stages, and ordered by total time
+    """
+    values = [
+        json.dumps({"stages": {"get_terms": {"seconds": s}, "save": {"seconds": 1}}})
+        for s in range(1, 101)
+    ]
+    values += ["{}", "", "not json"]
+    summary = summarize_stages(values)
+    assert [stage["stage"] for stage in summary] == ["get_terms", "save"]
+    get_terms = summary[0]
+    assert get_terms["count"] == 100
+    assert get_terms["seconds_p50"] == 50.5
+    assert get_terms["seconds_max"] == 100
@@ -0,0 +1,333 @@
+"""Tests for jobs.py."""
+
+import os
+import json
+import contextlib
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.searchterms.jobs import (
+    KEY_COL,
+    REFCOUNT_COL,
+    add_search_index_to_search_terms,
+    collect_resource_terms,
+    create_initial_searchterms,
+    get_datastore_fields,
+    get_datastore_records,
+    get_keycols,
+    get_terms_manifest,
+    hash_rows,
+    remove_resource_from_search_terms,
+    save_file,
+    update_searchterms,
+)
+from ckanext.searchterms import jobs
+from ckanext.searchterms.context import JobContext
+from ckanext.searchterms.util import (
+    BLANK,
+    MANIFEST_FIELD,
+    SEARCHTERMS_ERROR,
+    TERMS_RSRC_NAME,
+    get_resource_file_path,
+)
+
+
+def make_searchterms(rsrc_col, **columns):
+    return create_initial_searchterms(rsrc_col, pd.DataFrame(columns))
+
+
+def test_update_searchterms_upserts_by_identifiers():
+    """
+    Verify that rows with known identifiers are marked as found in the new
+    resource and rows with new identifiers are appended with their terms
+    """
+    existing = make_searchterms("rsrc-1", id=["a", "b"], Term=["x", "y"])
+    new_terms = make_searchterms("rsrc-2", id=["b", "c", "c"], Term=["yy", "z", "z"])
+    merged = update_searchterms("rsrc-2", new_terms, existing)
+    assert merged["id"].tolist() == ["a", "b", "c"]
+    assert merged["Term"].tolist() == ["x", "y", "z"]
+    assert merged["rsrc-1"].tolist() == ["True", "True", ""]
+    assert merged["rsrc-2"].tolist() == ["", "True", "True"]
+
+
+def test_update_searchterms_keeps_row_keys_current():
+    """
+    Verify that the persisted row keys match a fresh hash of the identifiers
+    after repeated upserts
+    """
+    merged = make_searchterms("rsrc-1", id=["a", "b"], Term=["x", "y"])
+    for i, ids in enumerate([["b", "c"], ["d", "a"]], start=2):
+        new_terms = make_searchterms("rsrc-{0}".format(i), id=ids, Term=ids)
+        merged = update_searchterms("rsrc-{0}".format(i), new_terms, merged)
+    expected = hash_rows(merged, get_keycols(merged))
+    assert (merged[KEY_COL].to_numpy() == expected).all()
+
+
+def test_remove_resource_drops_rows_only_found_in_it():
+    """
+    Verify that removing a resource drops the rows no other resource has and
+    keeps shared rows
+    """
+    existing = make_searchterms("rsrc-1", id=["a", "b"], Term=["x", "y"])
+    new_terms = make_searchterms("rsrc-2", id=["b", "c"], Term=["y", "z"])
+    merged = update_searchterms("rsrc-2", new_terms, existing)
+    merged = remove_resource_from_search_terms("rsrc-1", merged)
+    assert merged["id"].tolist() == ["b", "c"]
+    assert merged[REFCOUNT_COL].tolist() == [1, 1]
+    merged = remove_resource_from_search_terms("rsrc-2", merged)
+    assert len(merged) == 0
+
+
+def test_collect_resource_terms_upserts_batches():
+    """
+    Verify that a resource's terms are built from its batches without
+    duplicate identifiers or internal columns
+    """
+    batches = iter(
+        [
+            pd.DataFrame({"id": ["a", "a", "b"], "Term": ["x", "x", "y"]}),
+            pd.DataFrame({"id": ["b", "c"], "Term": ["y", "z"]}),
+        ]
+    )
+    stages = {}
+    terms = collect_resource_terms("rsrc-1", [batches], stages)
+    assert terms["id"].tolist() == ["a", "b", "c"]
+    assert terms["rsrc-1"].tolist() == ["True", "True", "True"]
+    assert KEY_COL not in terms.columns and REFCOUNT_COL not in terms.columns
+    assert stages["get_terms"]["rows"] == 5
+
+
+def test_get_terms_manifest_reads_searchterms_resource():
+    manifest = {"rsrc-1": {"hash": "sha256:abc", "version": "plugin:1"}}
+    dataset = {
+        "resources": [
+            {"id": "data", "name": "Data"},
+            {"id": "terms", "searchterms_manifest": json.dumps(manifest)},
+        ]
+    }
+    assert get_terms_manifest(dataset, "terms") == manifest
+    assert get_terms_manifest(dataset, None) == {}
+
+
+def test_get_datastore_records_types_resource_columns():
+    searchterms_df = pd.DataFrame(
+        {
+            "id": ["a", "b"],
+            "Term 1": ["x", np.nan],
+            "rsrc-1": ["True", ""],
+            "search_index": ["x||a", "b"],
+            KEY_COL: [1, 2],
+        }
+    )
+    assert get_datastore_fields(searchterms_df) == [
+        {"id": "id", "type": "text"},
+        {"id": "Term 1", "type": "text"},
+        {"id": "rsrc-1", "type": "bool"},
+        {"id": "search_index", "type": "text"},
+    ]
+    assert get_datastore_records(searchterms_df) == [
+        {"id": "a", "Term 1": "x", "rsrc-1": True, "search_index": "x||a"},
+        {"id": "b", "Term 1": "", "rsrc-1": False, "search_index": "b"},
+    ]
+
+
+def test_terms_without_identifier_columns_are_keyed_on_terms(storage):
+    batches = iter(
+        [
+            pd.DataFrame({"Term 1": ["x", "x"], "Term 2": ["y", "y"]}),
+            pd.DataFrame({"Term 1": ["x", "z"], "Term 2": ["y", "w"]}),
+        ]
+    )
+    resource_df = collect_resource_terms("rsrc-1", [batches], {})
+    assert resource_df["Term 1"].tolist() == ["x", "z"]
+    metadata = save_file(resource_df, "pkg")
+    assert metadata["name"] == TERMS_RSRC_NAME
+
+
+def test_search_index_joins_missing_values_as_blanks():
+    searchterms_df = pd.DataFrame({"id": ["b"], "Term": [None], "Term 2": ["y"]})
+    searchterms_df = add_search_index_to_search_terms(searchterms_df)
+    assert searchterms_df["search_index"].tolist() == ["||y||b"]
+
+
+def test_save_file_writes_to_resource_storage(storage):
+    searchterms_df = make_searchterms("rsrc-1", id=["a", "b"], Term=["x", "y"])
+    manifest = {"rsrc-1": {"hash": "h1", "version": "v1"}, "rsrc-2": {}}
+    metadata = save_file(searchterms_df, "pkg", manifest)
+    path = get_resource_file_path(metadata["id"])
+    written = pd.read_csv(path, sep="\t", dtype=str)
+    assert written.columns.tolist() == ["id", "Term", "rsrc-1"]
+    assert written["id"].tolist() == ["a", "b"]
+    assert metadata["size"] == os.path.getsize(path)
+    assert metadata["package_id"] == "pkg"
+    assert metadata["url_type"] == "upload"
+    assert metadata["format"] == "TSV"
+    # Resources without terms are left out of the manifest
+    assert json.loads(metadata[MANIFEST_FIELD]) == {
+        "rsrc-1": {"hash": "h1", "version": "v1"}
+    }
+
+
+def test_revise_search_terms_makes_one_package_revise(storage, monkeypatch):
+    monkeypatch.setattr(jobs, "enqueue_xloader_searchterms", lambda *a, **k: None)
+    revisions = []
+
+    def package_revise(context, data_dict):
+        revisions.append(data_dict)
+        return {"package": {"id": "pkg"}}
+
+    actions = {
+        "get_site_user": lambda context, data_dict: {"name": "site"},
+        "package_revise": package_revise,
+    }
+    monkeypatch.setattr(tk, "get_action", lambda action: actions[action])
+    job = JobContext()
+    new_resource = {"id": "terms-2", "name": TERMS_RSRC_NAME}
+    jobs.revise_search_terms(
+        job,
+        "pkg",
+        drop_ids=["terms-1"],
+        new_resource=new_resource,
+        errors={"rsrc-3": "Unable to parse"},
+    )
+    assert revisions == [
+        {
+            "match__id": "pkg",
+            "filter": ["-resources__terms-1"],
+            "update__resources__extend": [new_resource],
+            "update": {SEARCHTERMS_ERROR: BLANK},
+            "update__resources__rsrc-3": {SEARCHTERMS_ERROR: "Unable to parse"},
+        }
+    ]
+    assert job.action_calls["package_revise"] == 1
+
+
+class FakeCatalog:
+    """
+    Just enough of the actions used by update_package_search_terms, for one
+    dataset whose resources each yield a term named after them.
+    """
+
+    def __init__(self, monkeypatch, resources, fail=False):
+        self.dataset = {"id": "pkg", "name": "pkg", "resources": resources}
+        self.tasks = {}
+        self.fail = fail
+        self.existing_terms = []
+        self.revisions = []
+        actions = {
+            "get_site_user": lambda context, data_dict: {"name": "site"},
+            "package_show": lambda context, data_dict: json.loads(
+                json.dumps(self.dataset)
+            ),
+            "task_status_show": self.task_status_show,
+            "task_status_update": self.task_status_update,
+            "package_revise": self.package_revise,
+        }
+        monkeypatch.setattr(tk, "get_action", lambda action: actions[action])
+        monkeypatch.setattr(jobs, "package_lock", contextlib.nullcontext)
+        monkeypatch.setattr(jobs, "enqueue_xloader_searchterms", lambda *a, **k: None)
+        monkeypatch.setattr(jobs, "is_eligible", lambda resource: True)
+        monkeypatch.setattr(jobs, "iter_implementer_terms", self.iter_implementer_terms)
+
+    def iter_implementer_terms(self, resource, dataset, existing_terms):
+        self.existing_terms.append(existing_terms)
+        if self.fail:
+            raise ValueError("Plugin failed")
+        yield iter(
+            [pd.DataFrame({"id": [resource["id"]], "Term": ["t-" + resource["id"]]})]
+        )
+
+    def task_status_show(self, context, data_dict):
+        return self.tasks.get(data_dict["entity_id"], {})
+
+    def task_status_update(self, context, data_dict):
+        self.tasks[data_dict["entity_id"]] = dict(data_dict)
+        return data_dict
+
+    def package_revise(self, context, data_dict):
+        self.revisions.append(data_dict)
+        for resource_filter in data_dict.get("filter", []):
+            res_id = resource_filter.split("__", 1)[1]
+            self.dataset["resources"] = [
+                res for res in self.dataset["resources"] if res["id"] != res_id
+            ]
+        self.dataset["resources"].extend(data_dict.get("update__resources__extend", []))
+        return {"package": self.dataset}
+
+
+def test_rebuild_in_batches_keeps_other_resources(storage, monkeypatch):
+    r1 = {"id": "r1", "name": "r1", "package_id": "pkg"}
+    r2 = {"id": "r2", "name": "r2", "package_id": "pkg"}
+    FakeCatalog(monkeypatch, [r1, r2])
+    jobs.update_package_search_terms("pkg", [(r1, True)], rebuild=True)
+    searchterms_df = jobs.update_package_search_terms(
+        "pkg", [(r2, True)], rebuild=True, force=True
+    )
+    assert jobs.get_rsrccols(searchterms_df) == ["rsrc-r1", "rsrc-r2"]
+
+
+def test_rebuild_drops_removed_resources(storage, monkeypatch):
+    r1 = {"id": "r1", "name": "r1", "package_id": "pkg"}
+    r2 = {"id": "r2", "name": "r2", "package_id": "pkg"}
+    catalog = FakeCatalog(monkeypatch, [r1, r2])
+    jobs.update_package_search_terms("pkg", [(r1, False), (r2, False)])
+    catalog.dataset["resources"].remove(r2)
+    searchterms_df = jobs.update_package_search_terms("pkg", [(r1, True)], rebuild=True)
+    assert jobs.get_rsrccols(searchterms_df) == ["rsrc-r1"]
+
+
+def test_unchanged_resources_are_skipped(storage, monkeypatch):
+    r1 = {"id": "r1", "name": "r1", "package_id": "pkg", "hash": "h1"}
+    catalog = FakeCatalog(monkeypatch, [r1])
+    saved = []
+
+    def spy_save_file(*args, **kwargs):
+        saved.append(args)
+        return save_file(*args, **kwargs)
+
+    monkeypatch.setattr(jobs, "save_file", spy_save_file)
+    jobs.update_package_search_terms("pkg", [(r1, True)])
+    assert len(saved) == len(catalog.revisions) == 1
+    catalog.tasks.clear()
+    # Same file and plugin version, without force
+    assert jobs.update_package_search_terms("pkg", [(r1, True)]) is None
+    assert len(saved) == len(catalog.revisions) == 1
+    assert len(catalog.existing_terms) == 1
+    assert catalog.tasks["r1"]["state"] == "complete"
+
+
+def test_plugins_are_not_given_internal_columns(storage, monkeypatch):
+    r1 = {"id": "r1", "name": "r1", "package_id": "pkg"}
+    r2 = {"id": "r2", "name": "r2", "package_id": "pkg"}
+    catalog = FakeCatalog(monkeypatch, [r1, r2])
+    jobs.update_package_search_terms("pkg", [(r1, False)])
+    jobs.update_package_search_terms("pkg", [(r2, False)])
+    assert catalog.existing_terms[0] is None
+    assert catalog.existing_terms[1].columns.tolist() == [
+        "id",
+        "Term",
+        "rsrc-r1",
+        "search_index",
+    ]
+
+
+def test_update_package_search_terms_raises_on_failure(storage, monkeypatch):
+    r1 = {"id": "r1", "name": "r1", "package_id": "pkg"}
+    catalog = FakeCatalog(monkeypatch, [r1], fail=True)
+    with pytest.raises(ValueError):
+        jobs.update_package_search_terms("pkg", [(r1, False)])
+    assert catalog.tasks["r1"]["state"] == "error"
+
+
+def test_check_manifest_saved_warns_when_dropped(caplog):
+    new_resource = {"id": "terms-1", MANIFEST_FIELD: json.dumps({"rsrc-1": {}})}
+    saved = {"package": {"resources": [dict(new_resource)]}}
+    jobs.check_manifest_saved(saved, new_resource)
+    assert not caplog.records
+    dropped = {"package": {"resources": [{"id": "terms-1"}]}}
+    jobs.check_manifest_saved(dropped, new_resource)
+    assert MANIFEST_FIELD in caplog.records[0].getMessage()
@@ -0,0 +1,36 @@
+"""Tests for locks.py."""
+
+import pytest
+from redis.exceptions import RedisError
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.searchterms import locks
+from ckanext.searchterms.constants import SearchtermsLockError
+
+
+@pytest.fixture
+def file_locks(storage, monkeypatch):
+    """
+    Makes package_lock fall back to file locks, as without Redis.
+    """
+
+    def connect_to_redis():
+        raise RedisError("unavailable")
+
+    monkeypatch.setattr(locks, "connect_to_redis", connect_to_redis)
+    monkeypatch.setattr(locks, "FILE_LOCK_POLL_SECONDS", 0.01)
+    monkeypatch.setitem(tk.config, locks.LOCK_WAIT, "0")
+
+
+def test_file_lock_times_out_while_held(file_locks):
+    with locks.package_lock("pkg-1"):
+        with pytest.raises(SearchtermsLockError):
+            with locks.package_lock("pkg-1"):
+                pass
+        # Other packages are not blocked
+        with locks.package_lock("pkg-2"):
+            pass
+    # Released once the block exits
+    with locks.package_lock("pkg-1"):
+        pass
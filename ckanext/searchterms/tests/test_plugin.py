@@ -1,11 +1,20 @@
 """Tests for plugin.py."""
 
+import json
+
+import pandas as pd
 import pytest
 
 from ckanext.searchterms.implementations import (
     is_eligible,
     # get_searchterms,
 )
+from ckanext.searchterms.cache import pipeline_write
+from ckanext.searchterms.plugin import (
+    build_field_payload,
+    build_index_payload,
+    get_pipeline_chunks,
+)
 
 
 @pytest.mark.ckan_config("ckan.plugins", "searchterms")
@@ -30,3 +39,47 @@ def test_mock_plugin_is_eligible(app):
     """
     resource = None
     assert is_eligible(resource) is True
+
+
+def test_build_index_payload_chunks_valid_terms(tmp_path):
+    """
+    Verify that the index payload streams a terms file into chunks of 100
+    terms, skipping blank and boolean cells
+    """
+    fpath = tmp_path / "terms.tsv"
+    rows = ["Term\trsrc-1"] + ["term{0}\tTrue".format(i) for i in range(250)]
+    fpath.write_text("\n".join(rows) + "\n")
+    chunks = pd.read_csv(str(fpath), sep="\t", dtype=str, chunksize=30)
+    payload = build_index_payload("pkg", chunks)
+    assert sorted(payload) == [
+        "extras_pkg_search_term_0",
+        "extras_pkg_search_term_1",
+        "extras_pkg_search_term_2",
+    ]
+    assert json.loads(payload["extras_pkg_search_term_2"]) == [
+        "term{0}".format(i) for i in range(200, 250)
+    ]
+
+
+def test_build_field_payload_dedupes_and_caps_terms():
+    """
+    Verify that the single-field payload normalizes whitespace, drops
+    case-insensitive duplicates and keeps at most max_terms terms
+    """
+    terms = ["Apple", " apple ", "Green  Pear", "green pear", "Plum", "Fig"]
+    payload = build_field_payload("pkg", iter(terms), "searchterms", max_terms=3)
+    assert payload == {"searchterms": ["Apple", "Green Pear", "Plum"]}
+
+
+def test_pipeline_chunks_only_for_the_written_terms_resource():
+    """
+    Verify that indexing takes the terms table from a searchterms job's own
+    write, and only for the package and terms resource being written
+    """
+    searchterms_df = pd.DataFrame({"Term": ["a"], "rsrc-1": ["True"]})
+    assert get_pipeline_chunks("pkg", "terms-1") is None
+    with pipeline_write("pkg", "terms-1", searchterms_df):
+        assert get_pipeline_chunks("pkg", "terms-1")[0] is searchterms_df
+        assert get_pipeline_chunks("pkg", "terms-2") is None
+        assert get_pipeline_chunks("other", "terms-1") is None
+    assert get_pipeline_chunks("pkg", "terms-1") is None
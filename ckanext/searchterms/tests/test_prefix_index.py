@@ -0,0 +1,72 @@
+"""Tests for prefix_index.py and the actions using it."""
+
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.searchterms import actions
+from ckanext.searchterms.jobs import build_dataset_prefix_index, save_file
+from ckanext.searchterms.prefix_index import get_prefix_index, write_prefix_index
+
+
+def test_prefix_index_finds_terms_case_insensitively(storage):
+    write_prefix_index("pkg-1", ["Zebra", "apple", "Apricot", "APPLE", "  banana  "])
+    index = get_prefix_index("pkg-1")
+    assert len(index) == 4
+    assert list(index.iter_prefix("AP")) == ["apple", "Apricot"]
+    assert list(index.iter_prefix("z")) == ["Zebra"]
+    assert list(index.iter_prefix("c")) == []
+    assert index.find("BANANA") == "banana"
+    assert index.find("ban") is None
+    assert get_prefix_index("pkg-2") is None
+
+
+def test_prefix_index_reopens_rewritten_file(storage):
+    write_prefix_index("pkg-1", ["apple"])
+    assert list(get_prefix_index("pkg-1").iter_prefix("a")) == ["apple"]
+    write_prefix_index("pkg-1", ["avocado"])
+    assert list(get_prefix_index("pkg-1").iter_prefix("a")) == ["avocado"]
+
+
+def test_actions_search_readable_datasets(storage, monkeypatch):
+    write_prefix_index("pkg-1", ["Aspirin", "Asthma", "Beta"])
+    write_prefix_index("private", ["Aspirin"])
+
+    class Package:
+        @staticmethod
+        def get(id_or_name):
+            if id_or_name in ("pkg-1", "private"):
+                return SimpleNamespace(id=id_or_name)
+
+    def check_access(action, context, data_dict):
+        if data_dict.get("id") == "private":
+            raise tk.NotAuthorized()
+
+    monkeypatch.setattr(actions, "model", SimpleNamespace(Package=Package))
+    monkeypatch.setattr(tk, "check_access", check_access)
+    assert actions.searchterms_autocomplete(
+        {}, {"package_id": "pkg-1", "q": "as", "limit": 5}
+    ) == ["Aspirin", "Asthma"]
+    assert (
+        actions.searchterms_lookup({}, {"package_id": "pkg-1", "term": "BETA"})
+        == "Beta"
+    )
+    assert actions.searchterms_lookup({}, {"package_id": "pkg-1", "term": "b"}) is None
+    with pytest.raises(tk.NotAuthorized):
+        actions.searchterms_autocomplete({}, {"package_id": "private", "q": "as"})
+    with pytest.raises(tk.ValidationError):
+        actions.searchterms_autocomplete({}, {"q": "as"})
+
+
+def test_dataset_prefix_index_is_built_from_terms_resource(storage):
+    searchterms_df = pd.DataFrame(
+        {"id": ["a", "b"], "Term": ["Xylose", None], "rsrc-1": ["True", "True"]}
+    )
+    terms_id = save_file(searchterms_df, "pkg-1")["id"]
+    assert get_prefix_index("pkg-1") is None
+    assert build_dataset_prefix_index("pkg-1", terms_id) == 2
+    index = get_prefix_index("pkg-1")
+    assert list(index.iter_prefix("")) == ["a", "b", "Xylose"]
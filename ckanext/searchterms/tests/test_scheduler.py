@@ -0,0 +1,103 @@
+"""Tests for scheduler.py."""
+
+import pytest
+
+import ckan.plugins.toolkit as tk
+
+from ckanext.searchterms import jobs, scheduler
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    """
+    Points the scheduler at an in-memory Redis.
+    """
+    conn = fakeredis.FakeRedis()
+    monkeypatch.setattr(scheduler, "connect_to_redis", lambda: conn)
+    return conn
+
+
+@pytest.fixture
+def failed_jobs(conn, monkeypatch):
+    """
+    Returns the set of job ids reported as failed.
+    """
+    failed = set()
+    monkeypatch.setattr(
+        scheduler, "is_failed_job", lambda job_id, conn: job_id in failed
+    )
+    return failed
+
+
+def make_resource(res_id):
+    return {"id": res_id, "package_id": "pkg", "name": res_id}
+
+
+def test_pending_resources_are_drained_by_one_job(conn, failed_jobs):
+    scheduler.add_pending_resource(make_resource("r1"))
+    assert scheduler.claim_package_job("pkg", "job-1") == ("job-1", True)
+    scheduler.add_pending_resource(make_resource("r2"), True, ["rebuild"])
+    scheduler.add_pending_resource(make_resource("r1"), True)
+    assert scheduler.claim_package_job("pkg", "job-2") == ("job-1", False)
+    resources, options = scheduler.drain_pending_resources("pkg")
+    assert sorted((res["id"], updated) for res, updated in resources) == [
+        ("r1", True),
+        ("r2", True),
+    ]
+    assert options == {"rebuild"}
+    assert scheduler.drain_pending_resources("pkg") == ([], set())
+    # Draining clears the claim for the next resource
+    assert scheduler.claim_package_job("pkg", "job-3") == ("job-3", True)
+
+
+def test_pending_resources_do_not_expire(conn, failed_jobs):
+    scheduler.add_pending_resource(make_resource("r1"), options=["force"])
+    scheduler.claim_package_job("pkg", "job-1")
+    # A job queued behind a long backfill still finds its resources
+    assert conn.ttl(scheduler._key("pending", "pkg")) == -1
+    assert conn.ttl(scheduler._key("options", "pkg")) == -1
+    assert conn.ttl(scheduler._key("scheduled", "pkg")) == -1
+
+
+def test_package_claim_is_taken_over_after_failed_job(conn, failed_jobs):
+    scheduler.add_pending_resource(make_resource("r1"))
+    assert scheduler.claim_package_job("pkg", "job-1") == ("job-1", True)
+    failed_jobs.add("job-1")
+    assert scheduler.claim_package_job("pkg", "job-2") == ("job-2", True)
+    assert scheduler.claim_package_job("pkg", "job-3") == ("job-2", False)
+
+
+def test_failed_enqueue_releases_package_claim(conn, failed_jobs, monkeypatch):
+    monkeypatch.setattr(jobs, "is_eligible", lambda resource: True)
+    monkeypatch.setattr(tk, "get_action", lambda action: lambda context, data: data)
+
+    def enqueue_job(*args, **kwargs):
+        raise ConnectionError("Queue unavailable")
+
+    monkeypatch.setattr(tk, "enqueue_job", enqueue_job)
+    jobs.enqueue_terms_job(make_resource("r1"))
+    # The resource stays pending for the job the next upload schedules
+    assert scheduler.claim_package_job("pkg", "job-2") == ("job-2", True)
+    resources, _ = scheduler.drain_pending_resources("pkg")
+    assert [res["id"] for res, _ in resources] == ["r1"]
+
+
+def test_release_package_job_keeps_other_claims(conn, failed_jobs):
+    scheduler.claim_package_job("pkg", "job-1")
+    scheduler.release_package_job("pkg", "job-2")
+    assert scheduler.claim_package_job("pkg", "job-3") == ("job-1", False)
+    scheduler.release_package_job("pkg", "job-1")
+    assert scheduler.claim_package_job("pkg", "job-3") == ("job-3", True)
+
+
+def test_xloader_claim_is_taken_over_after_failed_dependency(failed_jobs):
+    assert scheduler.claim_xloader_job("pkg", "job-1")
+    assert not scheduler.claim_xloader_job("pkg", "job-2")
+    # job-1 failed, so the xloader job waiting for it will never run
+    failed_jobs.add("job-1")
+    assert scheduler.claim_xloader_job("pkg", "job-3")
+    assert not scheduler.claim_xloader_job("pkg", "job-4")
+    scheduler.release_xloader_job("pkg")
+    assert scheduler.claim_xloader_job("pkg")
@@ -0,0 +1,44 @@
+"""Tests for storage.py."""
+
+import os
+
+import pandas as pd
+import pytest
+
+from ckanext.searchterms.storage import (
+    get_search_terms_source,
+    get_sidecar_path,
+    has_sidecar,
+    read_search_terms,
+    write_search_terms_file,
+    write_sidecar,
+)
+from ckanext.searchterms.util import get_resource_file_path
+
+pytest.importorskip("pyarrow")
+
+
+def write_terms(searchterms_df, resource_id="terms-1"):
+    write_search_terms_file(searchterms_df, resource_id, ["id", "Term"])
+    write_sidecar(searchterms_df, resource_id)
+
+
+def test_search_terms_are_read_from_sidecar(storage):
+    write_terms(pd.DataFrame({"id": ["a"], "Term": ["x"], "_key": [1]}))
+    assert has_sidecar("terms-1")
+    assert read_search_terms("terms-1").columns.tolist() == [
+        "id",
+        "Term",
+        "_key",
+    ]
+
+
+def test_sidecar_is_dropped_when_tsv_is_replaced(storage):
+    write_terms(pd.DataFrame({"id": ["a"], "Term": ["x"]}))
+    # e.g. an admin uploads a new file for the searchterms resource
+    pd.DataFrame({"id": ["b"], "Term": ["yy"]}).to_csv(
+        get_resource_file_path("terms-1"), sep="\t", index=False
+    )
+    assert read_search_terms("terms-1")["Term"].tolist() == ["yy"]
+    assert not os.path.exists(get_sidecar_path("terms-1"))
+    assert get_search_terms_source("terms-1") == get_resource_file_path("terms-1")
@@ -0,0 +1,33 @@
+"""Tests for terms_cache.py."""
+
+import os
+
+import pandas as pd
+import pytest
+
+from ckanext.searchterms import terms_cache
+
+pytest.importorskip("pyarrow")
+
+
+def test_cached_terms_round_trip(storage):
+    terms_df = pd.DataFrame({"id": ["a", "b"], "Term 1": ["x", "y"]})
+    assert terms_cache.get_cached_terms("hash-1", "v1") is None
+    terms_cache.set_cached_terms("hash-1", "v1", terms_df)
+    pd.testing.assert_frame_equal(
+        terms_cache.get_cached_terms("hash-1", "v1"), terms_df
+    )
+    # A new implementation version misses the cache
+    assert terms_cache.get_cached_terms("hash-1", "v2") is None
+
+
+def test_evict_removes_least_recently_used(storage):
+    terms_df = pd.DataFrame({"id": ["a"]})
+    for i, content_hash in enumerate(["hash-1", "hash-2", "hash-3"]):
+        terms_cache.set_cached_terms(content_hash, "v1", terms_df)
+        path = terms_cache.get_cache_path(content_hash, "v1")
+        os.utime(path, ns=(i * 10**9, i * 10**9))
+    size = os.path.getsize(terms_cache.get_cache_path("hash-1", "v1"))
+    terms_cache.evict(2 * size)
+    assert terms_cache.get_cached_terms("hash-1", "v1") is None
+    assert terms_cache.get_cached_terms("hash-3", "v1") is not None
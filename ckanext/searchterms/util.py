@@ -1,4 +1,5 @@
 import os
+import hashlib
 import logging
 
 from ckan import model
@@ -6,6 +7,11 @@ import ckan.plugins.toolkit as tk
 
 SEARCHTERMS_ERROR = "searchterms_error"
 TERMS_RSRC_NAME = "Search Terms"
+TERMS_FILENAME = "searchterms.tsv"
+# Field of the searchterms resource recording what each resource's terms
+# were generated from
+MANIFEST_FIELD = "searchterms_manifest"
+HASH_BLOCK_SIZE = 2**20
 TRUE = True
 BLANK = ""
 
@@ -19,6 +25,38 @@ def get_resource_file_path(id):
     return base + "/resources/" + dir1 + "/" + dir2 + "/" + id[6:]
 
 
+def get_resource_hash(resource):
+    """
+    Returns a hash of an uploaded resource's file, or the resource's `hash`
+    field for other resources, or None if neither is available.
+    """
+    if resource.get("url_type") == "upload":
+        filepath = get_resource_file_path(resource.get("id"))
+        if os.path.exists(filepath):
+            sha256 = hashlib.sha256()
+            with open(filepath, "rb") as resource_file:
+                for block in iter(lambda: resource_file.read(HASH_BLOCK_SIZE), b""):
+                    sha256.update(block)
+            return "sha256:" + sha256.hexdigest()
+    return resource.get("hash") or None
+
+
 def site_user_context():
     user = tk.get_action("get_site_user")({"model": model, "ignore_auth": True}, {})
     return {"ignore_auth": True, "user": user["name"], "auth_user_obj": None}
+
+
+def get_terms_resource_ids(package_ids=None):
+    """
+    Returns a dict of package id to search terms resource id for the given
+    packages (or every package), resolved with a single query.
+    """
+    query = model.Session.query(model.Resource.package_id, model.Resource.id).filter(
+        model.Resource.name == TERMS_RSRC_NAME,
+        model.Resource.state == "active",
+    )
+    if package_ids is not None:
+        query = query.filter(model.Resource.package_id.in_(package_ids))
+    # Ordered so the first terms resource of a package wins, as in package_show
+    query = query.order_by(model.Resource.package_id, model.Resource.position.desc())
+    return {package_id: resource_id for package_id, resource_id in query}